@@ -1,7 +1,12 @@
 # Запуск: streamlit run nuz_dashboard_app_v4.py
 from __future__ import annotations
 
+import hashlib
+import importlib.util
 import re
+import threading
+import weakref
+import zlib
 from dataclasses import dataclass
 from enum import Enum
 from io import BytesIO
@@ -9,15 +14,20 @@ from pathlib import Path
 from typing import Any, Dict, List, Tuple
 from uuid import uuid4
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+from pandas.api.types import union_categoricals
 from plotly.colors import qualitative as qcolors
 from plotly.subplots import make_subplots
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from openpyxl import load_workbook
 
 # A) Глобальные флаги
 APP_VERSION = "v24.56-heatmap-fix"
@@ -25,6 +35,16 @@ APP_VERSION = "v24.56-heatmap-fix"
 SIMPLE_MODE = True
 # Аналитика только по НЮЗ
 NUZ_ONLY = True
+# Сколько файлов разбираем параллельно
+PARSE_WORKERS = 8
+# Сколько метрик готовим параллельно для графиков сравнения
+PREP_WORKERS = 8
+# С какого числа точек на графике переходить на WebGL (go.Scattergl)
+WEBGL_MIN_POINTS = 1000
+# Быстрый Rust-движок чтения Excel (pandas engine="calamine"), если установлен
+HAS_CALAMINE = importlib.util.find_spec("python_calamine") is not None
+# Текстовые колонки с длинным хвостом значений (Подразделение) — в Arrow, если он есть (ставится со streamlit)
+TEXT_DTYPE = "string[pyarrow]" if importlib.util.find_spec("pyarrow") is not None else "string"
 
 # A) Вспомогательные функции для года
 YEAR_RE = re.compile(r"(?<!\d)(20\d{2})(?!\d)")
@@ -61,59 +81,83 @@ def guess_year_from_filename(name: str) -> int | None:
     return int(m.group(1)) if m else None
 
 
+_REGION_PAREN_RE = re.compile(r"\s*\(.*?\)")
+
+
 def _resolve_region_coordinates_static(name: str) -> tuple[float, float] | None:
+    # ключи индекса в нижнем регистре: полное имя, затем часть после «Префикс:», затем без скобок
     if not name:
         return None
-    raw = str(name).strip()
-    candidates = {raw}
-    if ":" in raw:
-        candidates.add(raw.split(":", 1)[-1].strip())
-    simplified = re.sub(r"\s*\(.*?\)", "", raw).strip()
-    candidates.add(simplified)
-    for candidate in candidates:
-        key = candidate.lower()
-        coords = REGION_COORDS_INDEX.get(key)
-        if coords:
-            return coords
-        titled = candidate.title()
-        coords = REGION_COORDS_INDEX.get(titled.lower())
+    key = str(name).strip().lower()
+    coords = REGION_COORDS_INDEX.get(key)
+    if coords:
+        return coords
+    if ":" in key:
+        coords = REGION_COORDS_INDEX.get(key.split(":", 1)[-1].strip())
         if coords:
             return coords
+    if "(" in key:
+        return REGION_COORDS_INDEX.get(_REGION_PAREN_RE.sub("", key).strip())
     return None
 
 
+@st.cache_resource
+def _http_session() -> requests.Session:
+    """Одна HTTP-сессия на процесс: keep-alive вместо нового TCP/TLS-рукопожатия на каждый запрос."""
+    session = requests.Session()
+    session.headers["User-Agent"] = f"NUZ-Dashboard/{APP_VERSION}"
+    return session
+
+
+@st.cache_data(show_spinner=False, persist="disk")
 def _geocode_region(name: str) -> tuple[float, float] | None:
+    """
+    Координаты из Nominatim. Ответ (в т.ч. «не найдено») кэшируется на диск — общий для сессий и перезапусков;
+    сетевые ошибки пробрасываются наружу, чтобы временный сбой не закэшировался.
+    """
     if not name:
         return None
-    try:
-        headers = {"User-Agent": f"NUZ-Dashboard/{APP_VERSION}"}
-        params = {"q": name, "format": "json", "limit": 1, "addressdetails": 0}
-        resp = requests.get(REGION_GEOCODER_URL, params=params, headers=headers, timeout=8)
-        if resp.status_code != 200:
-            return None
-        payload = resp.json()
-        if not payload:
-            return None
-        lat = float(payload[0]["lat"])
-        lon = float(payload[0]["lon"])
-        return lat, lon
-    except Exception:
+    params = {"q": name, "format": "json", "limit": 1, "addressdetails": 0}
+    resp = _http_session().get(REGION_GEOCODER_URL, params=params, timeout=8)
+    resp.raise_for_status()
+    payload = resp.json()
+    if not payload:
         return None
+    lat = float(payload[0]["lat"])
+    lon = float(payload[0]["lon"])
+    return lat, lon
+
+
+@st.cache_resource
+def _region_coords_dynamic() -> Dict[str, tuple[float, float] | None]:
+    """Найденные геокодером координаты — один словарь на процесс, общий для всех сессий."""
+    return {}
 
 
 def resolve_region_coordinates(name: str) -> tuple[float, float] | None:
     cached = _resolve_region_coordinates_static(name)
     if cached:
         return cached
-    cache = st.session_state.setdefault("region_coords_dynamic", {})
+    cache = _region_coords_dynamic()
     if name in cache:
         return cache[name]
-    coords = _geocode_region(name)
+    try:
+        coords = _geocode_region(name)
+    except Exception:
+        return None
+    cache[name] = coords
     if coords:
-        cache[name] = coords
         REGION_COORDS_INDEX[name.lower()] = coords
     return coords
 
+
+def resolve_region_coordinates_many(names) -> Dict[str, tuple[float, float] | None]:
+    """
+    Координаты для набора регионов: каждое имя разрешается один раз (а не на каждую строку).
+    Геокодер опрашивается последовательно — Nominatim допускает не больше 1 запроса в секунду.
+    """
+    return {name: resolve_region_coordinates(name) for name in dict.fromkeys(map(str, names))}
+
 # ------------------------- Конфигурация страницы -------------------------
 st.set_page_config(page_title=f"НЮЗ — Дашборд {APP_VERSION}", layout="wide", page_icon="📊")
 st.markdown("""
@@ -336,13 +380,16 @@ ACCEPTED_METRICS_CANONICAL = {
 ACCEPTED_METRICS_CANONICAL |= {Metrics.DEBT.value}
 
 
+# ё → е и кавычки → пробел одной таблицей str.translate, без отдельных replace/regex
+_METRIC_LABEL_TABLE = str.maketrans({"ё": "е", '"': " ", "'": " ", "«": " ", "»": " "})
+_METRIC_SPACES_RE = re.compile(r"\s+")
+
+
 def _normalize_metric_label(raw: str) -> str:
     if raw is None:
         return ""
-    s = str(raw).lower()
-    s = s.replace("ё", "е")
-    s = re.sub(r"[\"'«»]", " ", s)
-    s = re.sub(r"\s+", " ", s)
+    s = str(raw).lower().translate(_METRIC_LABEL_TABLE)
+    s = _METRIC_SPACES_RE.sub(" ", s)
     return s.strip(" :;.")
 
 
@@ -485,6 +532,33 @@ HIDDEN_METRICS = {
 }
 
 
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    pd.concat без распада категорий: при разных наборах категорий pandas склеивает колонку
+    через object-массив строк. Такие колонки сводим union_categoricals — склейка идёт по кодам.
+    """
+    columns = list(frames[0].columns)
+    if len(frames) < 2 or any(set(f.columns) != set(columns) for f in frames[1:]):
+        return pd.concat(frames, ignore_index=True)
+    out: Dict[str, Any] = {}
+    for col in columns:
+        parts = [f[col] for f in frames]
+        dtypes = [p.dtype for p in parts]
+        if isinstance(dtypes[0], pd.CategoricalDtype) and any(d != dtypes[0] for d in dtypes[1:]):
+            ordered = dtypes[0].ordered
+            try:
+                # неупорядоченные категории сортируем — как astype("category") после обычного concat
+                cat = union_categoricals([p if isinstance(p.dtype, pd.CategoricalDtype) else p.astype("category")
+                                          for p in parts], sort_categories=not ordered, ignore_order=True)
+            except TypeError:  # несравнимые значения в категориях
+                out[col] = pd.concat(parts, ignore_index=True)
+                continue
+            out[col] = pd.Series(cat.as_ordered() if ordered else cat)
+        else:
+            out[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(out, copy=False)
+
+
 def append_risk_share_metric(df: pd.DataFrame) -> pd.DataFrame:
     needed = {Metrics.BELOW_LOAN.value, Metrics.REVENUE.value, Metrics.DEBT_NO_SALE.value}
     present = set(df["Показатель"].dropna().unique())
@@ -496,7 +570,7 @@ def append_risk_share_metric(df: pd.DataFrame) -> pd.DataFrame:
     if subset.empty:
         return df
     subset["Значение"] = pd.to_numeric(subset["Значение"], errors="coerce")
-    pivot = subset.pivot_table(index=cols, columns="Показатель", values="Значение", aggfunc="sum")
+    pivot = subset.pivot_table(index=cols, columns="Показатель", values="Значение", aggfunc="sum", observed=True)
     if pivot.empty:
         return df
 
@@ -506,7 +580,8 @@ def append_risk_share_metric(df: pd.DataFrame) -> pd.DataFrame:
     below = pivot.get(Metrics.BELOW_LOAN.value)
     if revenue is not None and below is not None:
         denominator = revenue.replace(0, np.nan)
-        ratio = (below / denominator) * 100.0
+        # есть выручка, а строки «ниже займа» нет — это 0, а не пропуск
+        ratio = (below.fillna(0.0) / denominator) * 100.0
         ratio = ratio.replace([np.inf, -np.inf], np.nan).dropna()
         if not ratio.empty:
             risk_df = ratio.reset_index().rename(columns={0: "Значение"})
@@ -519,18 +594,26 @@ def append_risk_share_metric(df: pd.DataFrame) -> pd.DataFrame:
     derived = pd.concat(derived_frames, ignore_index=True)
     derived["ИсточникФайла"] = "DERIVED"
     order = ["Регион", "Подразделение", "Категория", "Код", "Показатель", "Месяц", "Значение", "Год", "ИсточникФайла"]
+    if TOTALS_FLAG_COL in df.columns:
+        derived[TOTALS_FLAG_COL] = totals_flag(derived["Подразделение"])
+        order.append(TOTALS_FLAG_COL)
     for col in order:
         if col not in derived:
             derived[col] = pd.NA
 
     key_cols = ["Регион", "Подразделение", "Категория", "Код", "Показатель", "Месяц", "Год"]
-    existing_keys = set(tuple(row) for row in df[df["Показатель"] == Metrics.RISK_SHARE.value][key_cols].itertuples(index=False, name=None))
-    derived = derived[~derived[key_cols].apply(tuple, axis=1).isin(existing_keys)]
-    return pd.concat([df, derived[order]], ignore_index=True)
+    # уже посчитанные в файле ключи отсекаем хэш-сравнением MultiIndex, без кортежа на строку
+    existing = df.loc[(df["Показатель"] == Metrics.RISK_SHARE.value).to_numpy(), key_cols]
+    if not existing.empty:
+        derived_keys = pd.MultiIndex.from_frame(derived[key_cols])
+        derived = derived[~derived_keys.isin(pd.MultiIndex.from_frame(existing))]
+    return concat_frames([df, derived[order]])
 
 
 ORDER = ["Январь","Февраль","Март","Апрель","Май","Июнь","Июль","Август","Сентябрь","Октябрь","Ноябрь","Декабрь"]
 ORDER_WITH_TOTAL = ORDER + ["Итого"]
+# Позиция месяца в календаре — O(1) вместо ORDER.index
+_ORDER_POS: dict[str, int] = {m: i for i, m in enumerate(ORDER)}
 
 NUZ_ACTIVITY_METRICS = {
     Metrics.LOAN_ISSUE.value,
@@ -602,46 +685,140 @@ TAB_METRIC_SETS: Dict[str, List[str]] = {
     ],
 }
 
-def _month_sort_key(m: str) -> int:
-    return ORDER.index(m) if m in ORDER else len(ORDER) + 1
+# Флаг строк «Итого …» по подразделению, считается один раз при загрузке
+TOTALS_FLAG_COL = "__is_itogo__"
+_TOTALS_RE = re.compile(r"^\s*итого\b", re.IGNORECASE)
+
+def totals_flag(branches: pd.Series) -> pd.Series:
+    # подразделения повторяются по всем показателям и месяцам — regex гоняем по уникальным названиям,
+    # строки получают флаг по кодам factorize; движок re, не RE2 из Arrow: там \b только ASCII
+    codes, uniques = pd.factorize(branches)
+    hit = np.fromiter((_TOTALS_RE.match(str(u)) is not None for u in uniques), dtype=bool, count=len(uniques))
+    flags = np.zeros(len(codes), dtype=bool)
+    known = codes >= 0
+    flags[known] = hit[codes[known]]
+    return pd.Series(flags, index=branches.index, name=branches.name)
+
+def category_mask(col: pd.Series, values) -> np.ndarray:
+    """isin по кодам категорий: значения переводим в коды один раз, дальше сравниваются целые."""
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        return col.isin(values).to_numpy()
+    codes = col.cat.categories.get_indexer(list(values))
+    return np.isin(col.cat.codes.to_numpy(), codes[codes >= 0])
+
+def branch_names(df: pd.DataFrame) -> set:
+    """Подразделения без строк «Итого»: берём одну колонку по маске, без копии всей таблицы."""
+    return set(df.loc[~totals_row_mask(df).to_numpy(dtype=bool), "Подразделение"].dropna().unique())
+
+def totals_row_mask(df: pd.DataFrame) -> pd.Series:
+    if TOTALS_FLAG_COL in df.columns:
+        return df[TOTALS_FLAG_COL]
+    return totals_flag(df["Подразделение"])
+
+# Срезы df_all по годам в сессии: «набор файлов:год» → DataFrame
+YEAR_FRAMES_KEY = "year_frames"
+YEAR_FRAMES_SIZE = 8
+# Разобранные в этой сессии файлы: (имя, отпечаток, регион, год) → DataFrame
+PARSED_CACHE_KEY = "parsed_cache"
+
+def frame_digest(df: pd.DataFrame) -> str:
+    """Отпечаток содержимого таблицы: построчные хэши pandas → blake2b."""
+    return content_digest(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+
+def frame_id(df: pd.DataFrame) -> str:
+    """
+    Ключ таблицы для st.cache_data. Хэш считается один раз на объект; сама таблица
+    передаётся в кэшируемую функцию рядом с ключом нехэшируемым аргументом _df.
+    """
+    ids = st.session_state.setdefault("df_ids", {})
+    hit = ids.get(id(df))
+    if hit is not None and hit[0]() is df:
+        return hit[1]
+    key = frame_digest(df)
+    ids[id(df)] = (weakref.ref(df, lambda _, k=id(df): ids.pop(k, None)), key)
+    return key
+
+def register_frame(df: pd.DataFrame, key: str) -> str:
+    """
+    Ключ таблицы известен заранее (набор файлов + год) — запоминаем его за объектом,
+    чтобы frame_id не хэшировал содержимое заново на каждом перезапуске.
+    """
+    ids = st.session_state.setdefault("df_ids", {})
+    ids[id(df)] = (weakref.ref(df, lambda _, k=id(df): ids.pop(k, None)), key)
+    return key
+
+def year_frame(df_all: pd.DataFrame, data_key: str, year: int) -> pd.DataFrame:
+    """
+    Срез df_all за год. Лежит в сессии под ключом «набор файлов:год»: на перезапусках
+    (смена вкладки, периода, регионов) маска по всему df_all не пересчитывается.
+    """
+    key = f"{data_key}:{year}"
+    frames = st.session_state.setdefault(YEAR_FRAMES_KEY, {})
+    df = frames.pop(key, None)
+    if df is None:
+        df = df_all[df_all["Год"] == year]
+        register_frame(df, key)
+    frames[key] = df
+    while len(frames) > YEAR_FRAMES_SIZE:
+        frames.pop(next(iter(frames)))
+    return df
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _totals_row_index(df_id: str, _df_raw: pd.DataFrame) -> Dict[Tuple[str, str], np.ndarray]:
+    """Позиции помесячных строк «Итого» по ключу (Регион, Показатель) — один проход на датасет."""
+    df_raw = _df_raw
+    mask = totals_row_mask(df_raw) & (df_raw["Месяц"] != "Итого")
+    positions = np.flatnonzero(mask.to_numpy(dtype=bool))
+    groups = df_raw.loc[mask, ["Регион", "Показатель"]].groupby(["Регион", "Показатель"], observed=True, sort=False).indices
+    return {(str(reg), str(met)): positions[idx] for (reg, met), idx in groups.items()}
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _metric_names(df_ids: Tuple[str, ...], _dfs: Tuple[pd.DataFrame, ...]) -> List[str]:
+    names: set = set()
+    for df in _dfs:
+        names.update(df["Показатель"].dropna().unique())
+    return sorted(names)
+
+def raw_metric_names_of(*dfs: pd.DataFrame) -> List[str]:
+    """Отсортированные метрики из файлов (по одной или нескольким таблицам) — без concat, кэш по df_id."""
+    return list(_metric_names(tuple(frame_id(df) for df in dfs), dfs))
 
-@st.cache_data
 def get_monthly_totals_from_file(df_raw: pd.DataFrame, regions: Tuple[str, ...], metric: str) -> pd.DataFrame:
     """Возвращает помесячные значения из строк «Итого» по приоритету."""
-    base = df_raw[
-        df_raw["Регион"].isin(regions) &
-        (df_raw["Показатель"] == metric) &
-        (df_raw["Месяц"].astype(str) != "Итого") &
-        df_raw["Подразделение"].str.contains(r"^\s*итого\b", case=False, na=False)
-    ].copy()
-    if not base.empty:
+    # кэш по df_id: переключение виджетов не перехэширует df_raw на каждый показатель
+    return _monthly_totals(frame_id(df_raw), df_raw, tuple(regions), metric)
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def _monthly_totals(df_id: str, _df_raw: pd.DataFrame, regions: Tuple[str, ...], metric: str) -> pd.DataFrame:
+    df_raw = _df_raw
+    index = _totals_row_index(df_id, df_raw)
+    hits = [index[key] for key in ((str(reg), metric) for reg in regions) if key in index]
+    if hits:
+        # берём только нужные колонки — без полной копии строк df_raw
+        cols = [c for c in ("Регион", "Месяц", "Значение", "ИсточникФайла") if c in df_raw.columns]
+        base = df_raw.iloc[np.sort(np.concatenate(hits)), df_raw.columns.get_indexer(cols)]
         priority_map = {"RECALC_TOTAL": 0, "TOTALS_FILE": 1}
-        src = base.get("ИсточникФайла", pd.Series(index=base.index, dtype=object))
-        prio = src.map(priority_map).fillna(2).astype(int)
-        base["__prio__"] = prio
-
-        def _select_best(g: pd.DataFrame) -> pd.Series:
-            priority_zero = g[g["__prio__"] == 0]
-            if not priority_zero.empty:
-                return priority_zero.iloc[0]
-            priority_one = g[g["__prio__"] == 1]
-            if not priority_one.empty:
-                return priority_one.iloc[0]
-            result = g.iloc[0].copy()
-            numeric_values = pd.to_numeric(g["Значение"], errors="coerce")
-            result["Значение"] = float(numeric_values.sum(skipna=True))
-            return result
-
-        return (base.groupby(["Регион", "Месяц"], observed=True)
-                    .apply(_select_best)
-                    .reset_index(drop=True)[["Регион", "Месяц", "Значение"]])
+        src = base.get("ИсточникФайла", pd.Series(index=base.index, dtype=object)).astype(object)
+        base = base.assign(__prio__=src.map(priority_map).fillna(2).astype(int))
+
+        # Одна строка на (Регион, Месяц): RECALC_TOTAL, затем TOTALS_FILE (первая по порядку);
+        # если ни одной — сумма значений группы. Без Python-функции на каждую группу.
+        keys = ["Регион", "Месяц"]
+        sums = base.groupby(keys, observed=True)["Значение"].sum()
+        best = (base.sort_values("__prio__", kind="mergesort")
+                    .drop_duplicates(keys)
+                    .set_index(keys)
+                    .reindex(sums.index))
+        values = best["Значение"].where(best["__prio__"].to_numpy() < 2, sums)
+        return values.reset_index().astype({"Регион": object, "Месяц": object})
 
     # Fallback: суммируем по всем подразделениям
-    subset = df_raw[
+    subset = df_raw.loc[
         df_raw["Регион"].isin(regions) &
         (df_raw["Показатель"] == metric) &
-        (df_raw["Месяц"].astype(str) != "Итого")
-    ].copy()
+        (df_raw["Месяц"] != "Итого"),
+        ["Регион", "Месяц", "Значение"]
+    ]
     if subset.empty:
         return pd.DataFrame()
 
@@ -667,28 +844,22 @@ def month_series_from_file(df_all, regions, metric, months):
     dfm = get_monthly_totals_from_file(df_all, tuple(regions), metric)
     if dfm.empty:
         return pd.Series(dtype=float)
-    s = (dfm[dfm["Месяц"].astype(str).isin(months_tuple)]
+    s = (dfm[dfm["Месяц"].isin(months_tuple)]
             .groupby("Месяц", observed=True)["Значение"].sum())
     # строгая сортировка по календарю
     s = s.reindex([m for m in months_tuple if m in s.index])
     return s
 
-@st.cache_data
 def sorted_months_safe(_values) -> list[str]:
-    """Без кеша: аккуратно приводим к строкам и сортируем по нашему ORDER."""
+    """Без кеша: сначала уникальные значения (для категорий — по кодам), к строкам — только их; порядок — по ORDER."""
     if _values is None:
         return []
-    s = pd.Series(_values)
-    if isinstance(s.dtype, pd.CategoricalDtype):
-        s = s.astype(str)
-    seq = [str(x) for x in s.dropna().astype(str)]
-    seq = [m for m in seq if m in ORDER]
-    seq = list(dict.fromkeys(seq))
-    return sorted(seq, key=_month_sort_key)
+    seen = {str(v) for v in pd.Series(_values).unique() if not pd.isna(v)}
+    return [m for m in ORDER if m in seen]
 
 # --- Агрегационные правила за период из строк «Итого по месяцу»
 # SUM: потоковые суммы за месяц (руб/шт) — складываем.
-AGG_SUM = {
+AGG_SUM = frozenset({
     Metrics.REVENUE.value, Metrics.LOAN_ISSUE.value, Metrics.PENALTIES_RECEIVED.value,
     Metrics.MARKUP_AMOUNT.value, Metrics.PENALTIES_PLUS_MARKUP.value,
     Metrics.LOAN_ISSUE_UNITS.value, Metrics.BELOW_LOAN.value, Metrics.BELOW_LOAN_UNITS.value,
@@ -697,10 +868,10 @@ AGG_SUM = {
     Metrics.LOAN_REPAYMENT_SUM.value, Metrics.LOSS_BELOW_LOAN.value,
     Metrics.BRANCH_NEW_COUNT.value, Metrics.BRANCH_CLOSED_COUNT.value,
     Metrics.UNIQUE_CLIENTS.value, Metrics.NEW_UNIQUE_CLIENTS.value,
-}
+})
 
 # MEAN: проценты/доли и средние показатели — усредняем по месяцам.
-AGG_MEAN = {
+AGG_MEAN = frozenset({
     Metrics.MARKUP_PCT.value, Metrics.YIELD.value,
     Metrics.ILLIQUID_BY_COUNT_PCT.value, Metrics.ILLIQUID_BY_VALUE_PCT.value,
     Metrics.ISSUE_SHARE.value, Metrics.DEBT_SHARE.value, Metrics.INTEREST_SHARE.value,
@@ -708,25 +879,31 @@ AGG_MEAN = {
     Metrics.AVG_LOAN.value,      # если берется из файла как «Итого по месяцу»
     Metrics.AVG_LOAN_TERM.value, # ⬅️ ВАЖНО: средний срок — среднее по месяцам
     Metrics.REDEEMED_SHARE_PCT.value,
-}
+})
 
 # LAST (снимок на конец месяца) — берём ПОСЛЕДНИЙ месяц периода.
-AGG_LAST = {
+AGG_LAST = frozenset({
     Metrics.DEBT.value,
     Metrics.DEBT_NO_SALE.value,
     Metrics.DEBT_UNITS.value,
     Metrics.BRANCH_COUNT.value,  # «Количество ломбардов» — снимок
-}
+})
 
-# (оставим для совместимости, если где-то используются)
-METRICS_SUM  = AGG_SUM.copy()
-METRICS_MEAN = AGG_MEAN.copy()
-METRICS_LAST = AGG_LAST.copy()
+# (оставим для совместимости, если где-то используются; frozenset — копировать не нужно)
+METRICS_SUM  = AGG_SUM
+METRICS_MEAN = AGG_MEAN
+METRICS_LAST = AGG_LAST
 
+# Правило по имени показателя одной таблицей (порядок слияния: SUM важнее MEAN важнее LAST)
+_AGG_RULE_BY_METRIC: dict[str, str] = (
+    {m: "last" for m in AGG_LAST} | {m: "mean" for m in AGG_MEAN} | {m: "sum" for m in AGG_SUM}
+)
+
+@lru_cache(maxsize=1024)
 def aggregation_rule(metric: str) -> str:
-    if metric in AGG_SUM:  return "sum"
-    if metric in AGG_MEAN: return "mean"
-    if metric in AGG_LAST: return "last"
+    rule = _AGG_RULE_BY_METRIC.get(metric)
+    if rule:
+        return rule
     # по умолчанию: проценты — mean, деньги/шт — sum
     return "mean" if is_percent_metric(metric) else "sum"
 
@@ -763,7 +940,7 @@ def period_value_from_itogo_for_region(df_all: pd.DataFrame, region: str, metric
     dfm = get_monthly_totals_from_file(df_all, (region,), metric)
     if dfm.empty:
         return None
-    part = dfm[dfm["Месяц"].astype(str).isin(months_tuple)]
+    part = dfm[dfm["Месяц"].isin(months_tuple)]
     if part.empty:
         return None
 
@@ -783,11 +960,9 @@ def period_value_from_itogo_for_region(df_all: pd.DataFrame, region: str, metric
         if snapshots_mode == "mean":
             return float(vals.mean())
         else:
-            # берём последнее по календарю
-            part = part.copy()
-            part["Месяц"] = pd.Categorical(part["Месяц"].astype(str), categories=ORDER, ordered=True)
-            part = part.sort_values("Месяц")
-            return float(pd.to_numeric(part["Значение"], errors="coerce").iloc[-1])
+            # берём последнее по календарю: позиция месяца — из _ORDER_POS, без Categorical и сортировки
+            last = np.argmax(part["Месяц"].map(_ORDER_POS).to_numpy(dtype=float))
+            return float(pd.to_numeric(part["Значение"], errors="coerce").iloc[last])
 
     # дефолт
     return float(vals.mean())
@@ -804,30 +979,66 @@ def period_values_by_region_from_itogo(df_all, regions, metric, months) -> dict[
     if dfm.empty:
         return {}
 
-    dfm = dfm[dfm["Месяц"].astype(str).isin(months_tuple)].copy()
+    dfm = dfm[dfm["Месяц"].isin(months_tuple)]
     if dfm.empty:
         return {}
 
     rule = aggregation_rule(metric)
-    out = {}
-    for reg, t in dfm.groupby("Регион"):
-        # Ensure months are sorted before taking the last value for 'last' rule
-        t = t.copy()
-        t['Месяц'] = pd.Categorical(t['Месяц'], categories=ORDER, ordered=True)
-        t = t.sort_values("Месяц")
-        vals = pd.to_numeric(t["Значение"], errors="coerce").dropna()
-        if vals.empty:
+    vals = dfm.assign(Значение=pd.to_numeric(dfm["Значение"], errors="coerce")).dropna(subset=["Значение"])
+    if rule == "last":
+        # календарный порядок по позиции месяца из _ORDER_POS
+        vals = vals.iloc[np.argsort(vals["Месяц"].map(_ORDER_POS).to_numpy(dtype=float), kind="stable")]
+    # одна агрегация на все регионы вместо цикла по группам
+    agg_fn = rule if rule in {"sum", "mean", "last"} else "mean"
+    grouped = vals.groupby(vals["Регион"].astype(str))["Значение"].agg(agg_fn)
+    return {reg: _maybe_scale_percent(metric, float(v)) for reg, v in grouped.items()}
+
+
+def period_values_matrix(df_all: pd.DataFrame, regions: Tuple[str, ...], metrics: Tuple[str, ...],
+                         months: Tuple[str, ...], *, snapshots_mode: str = "last") -> pd.DataFrame:
+    """
+    Таблица Регион × Показатель за период — те же значения, что period_value_from_itogo_for_region,
+    но одна выборка «Итого по месяцу» и одна агрегация на показатель вместо вызова на каждую клетку.
+    """
+    # кэш по df_id, как у get_aggregated_data: без хэширования df_all на каждом рендере
+    return _period_values_matrix(frame_id(df_all), df_all, tuple(regions), tuple(metrics), tuple(months), snapshots_mode)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _period_values_matrix(df_id: str, _df_all: pd.DataFrame, regions: Tuple[str, ...], metrics: Tuple[str, ...],
+                          months: Tuple[str, ...], snapshots_mode: str) -> pd.DataFrame:
+    df_all = _df_all
+    months_tuple = tuple(months)
+    regions = [str(r) for r in regions]
+    out = pd.DataFrame(np.nan, index=pd.Index(regions, name="Регион"), columns=list(metrics), dtype=float)
+    for metric in metrics:
+        dfm = get_monthly_totals_from_file(df_all, tuple(regions), metric)
+        present = set(dfm["Регион"].astype(str)) if not dfm.empty else set()
+        # регион без своих строк «Итого» считается по подразделениям — как при запросе по одному региону
+        parts = [dfm] + [get_monthly_totals_from_file(df_all, (reg,), metric) for reg in regions if reg not in present]
+        parts = [p for p in parts if not p.empty]
+        if not parts:
+            continue
+        part = pd.concat(parts, ignore_index=True)
+        part = part[part["Месяц"].isin(months_tuple)]
+        part = part.assign(
+            Регион=part["Регион"].astype(str),
+            Значение=pd.to_numeric(part["Значение"], errors="coerce"),
+        )
+        clean = part.dropna(subset=["Значение"])
+        if clean.empty:
             continue
 
+        rule = aggregation_rule(metric)
         if rule == "sum":
-            result = float(vals.sum())
-        elif rule == "mean":
-            result = float(vals.mean())
-        elif rule == "last":
-            result = float(vals.iloc[-1])
+            res = clean.groupby("Регион")["Значение"].sum()
+        elif rule == "last" and snapshots_mode != "mean":
+            # последний по календарю месяц региона (значение может быть пустым — как и раньше)
+            ordered = part.assign(__m__=pd.Categorical(part["Месяц"], categories=ORDER, ordered=True)).sort_values("__m__", kind="stable")
+            res = ordered.drop_duplicates("Регион", keep="last").set_index("Регион")["Значение"]
+            res = res.reindex(clean["Регион"].unique())
         else:
-            result = float(vals.mean())  # дефолт
-        out[str(reg)] = _maybe_scale_percent(metric, result)
+            res = clean.groupby("Регион")["Значение"].mean()
+        out[metric] = res.reindex(out.index)
     return out
 
 
@@ -981,6 +1192,7 @@ PERCENT_METRICS |= {
     Metrics.INTEREST_SHARE.value,
 }
 
+@lru_cache(maxsize=1024)
 def is_percent_metric(name: str) -> bool:
     if not name:
         return False
@@ -1042,8 +1254,8 @@ AI_REGION_METRICS = [
 
 
 def _forecast_target_label(last_month: str) -> str:
-    if last_month in ORDER:
-        idx = ORDER.index(last_month)
+    if last_month in _ORDER_POS:
+        idx = _ORDER_POS[last_month]
         if idx + 1 < len(ORDER):
             return ORDER[idx + 1]
         return f"{ORDER[0]} (следующий год)"
@@ -1161,10 +1373,7 @@ def _build_metric_matrix(df_source: pd.DataFrame, regions: List[str], months_ran
 
 
 def _future_month_labels(last_month: str, horizon: int) -> List[str]:
-    if last_month in ORDER:
-        base_index = ORDER.index(last_month)
-    else:
-        base_index = len(ORDER) - 1
+    base_index = _ORDER_POS.get(last_month, len(ORDER) - 1)
     labels: List[str] = []
     for step in range(1, horizon + 1):
         idx = (base_index + step) % len(ORDER)
@@ -1227,7 +1436,7 @@ def _seasonal_linear_forecast(series: pd.Series, horizon: int = 3) -> Dict[str,
         return {}
     seasonal_groups: Dict[int, List[float]] = defaultdict(list)
     for idx, label in enumerate(labels):
-        month_idx = ORDER.index(label) if label in ORDER else idx % len(ORDER)
+        month_idx = _ORDER_POS.get(label, idx % len(ORDER))
         seasonal_groups[month_idx].append(residuals[idx])
     if not seasonal_groups:
         return {}
@@ -1241,7 +1450,7 @@ def _seasonal_linear_forecast(series: pd.Series, horizon: int = 3) -> Dict[str,
         t = len(y) + step - 1
         base_value = intercept + slope * t
         month_key = future_label.split()[0]
-        month_idx = ORDER.index(month_key) if month_key in ORDER else t % len(ORDER)
+        month_idx = _ORDER_POS.get(month_key, t % len(ORDER))
         seasonal = seasonal_adjustment.get(month_idx, 0.0)
         value = base_value + seasonal
         band = 0.0 if sigma == 0.0 else 1.96 * sigma * np.sqrt(1 + step / max(len(y), 1))
@@ -2464,7 +2673,13 @@ def render_correlation_block(df_source: pd.DataFrame, regions: List[str], months
     if matrix.empty or matrix.shape[1] < 2:
         st.info("Для выбранного набора метрик недостаточно данных.")
         return
-    corr = matrix.corr()
+    values = matrix.to_numpy(dtype=np.float64)
+    if np.isnan(values).any():
+        corr = matrix.corr()
+    else:
+        # без пропусков — одна матрица ковариаций через numpy вместо попарного прохода pandas
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = pd.DataFrame(np.corrcoef(values, rowvar=False), index=matrix.columns, columns=matrix.columns)
     fig = go.Figure(data=go.Heatmap(
         z=corr.values,
         x=corr.columns,
@@ -2504,13 +2719,13 @@ def render_revenue_waterfall(ctx: PageContext) -> None:
     subset = ctx.df_current[
         (ctx.df_current["Регион"].isin(ctx.regions)) &
         (ctx.df_current["Показатель"] == Metrics.REVENUE.value) &
-        (ctx.df_current["Месяц"].astype(str).isin([start_month, end_month]))
+        (ctx.df_current["Месяц"].isin([start_month, end_month]))
     ]
     if subset.empty:
         subset = ctx.df_current[
             (ctx.df_current["Регион"].isin(ctx.regions)) &
             (ctx.df_current["Показатель"] == Metrics.REVENUE.value) &
-            (ctx.df_current["Месяц"].astype(str).isin(ctx.months_range))
+            (ctx.df_current["Месяц"].isin(ctx.months_range))
         ]
         if subset.empty:
             st.info("Нет данных по выручке для построения диаграммы.")
@@ -3094,7 +3309,7 @@ def risk_markup_heatmap_block(ctx: PageContext) -> None:
             on=["Регион", "Месяц"],
             how="left"
         )
-    merged = merged[merged["Месяц"].astype(str).isin(ctx.months_range)]
+    merged = merged[merged["Месяц"].isin(ctx.months_range)]
     merged["Risk"] = pd.to_numeric(merged["Risk"], errors="coerce")
     merged["Markup"] = pd.to_numeric(merged["Markup"], errors="coerce")
     merged["Revenue"] = pd.to_numeric(merged.get("Revenue"), errors="coerce")
@@ -3510,7 +3725,7 @@ def render_region_map_block(ctx: PageContext) -> None:
     sub = strip_totals_rows(ctx.df_current)
     sub = sub[
         (sub["Регион"].isin(ctx.regions)) &
-        (sub["Месяц"].astype(str).isin(ctx.months_range)) &
+        (sub["Месяц"].isin(ctx.months_range)) &
         (sub["Показатель"] == metric_key)
     ].copy()
     if sub.empty:
@@ -3534,8 +3749,9 @@ def render_region_map_block(ctx: PageContext) -> None:
 
     rows: List[Dict[str, Any]] = []
     missing_regions: List[str] = []
+    coords_by_region = resolve_region_coordinates_many(agg["Регион"].unique())
     for _, row in agg.iterrows():
-        coords = resolve_region_coordinates(str(row["Регион"]))
+        coords = coords_by_region[str(row["Регион"])]
         if not coords:
             missing_regions.append(str(row["Регион"]))
             continue
@@ -3556,7 +3772,8 @@ def render_region_map_block(ctx: PageContext) -> None:
     df_ranked = df_map.sort_values("Значение", ascending=percent_metric and metric_key in METRICS_SMALLER_IS_BETTER)
     if view_mode == "Лента лидеров" or df_map["lat"].isna().all():
         df_ranked = df_ranked.copy()
-        df_ranked["Ключ"] = df_ranked["Регион"] + " · " + df_ranked["Подразделение"].fillna("—")
+        # Регион — категория, Подразделение — string: склеиваем как обычные строки
+        df_ranked["Ключ"] = df_ranked["Регион"].astype(str) + " · " + df_ranked["Подразделение"].fillna("—").astype(str)
         df_ranked["Значение, отображение"] = df_ranked["Значение"].apply(
             lambda v: fmt_pct(v) if percent_metric else format_rub(v)
         )
@@ -3653,7 +3870,7 @@ def render_region_map_block(ctx: PageContext) -> None:  # override with matrix-b
     sub = strip_totals_rows(ctx.df_current)
     sub = sub[
         (sub["Регион"].isin(ctx.regions)) &
-        (sub["Месяц"].astype(str).isin(ctx.months_range)) &
+        (sub["Месяц"].isin(ctx.months_range)) &
         (sub["Показатель"] == metric_key)
     ].copy()
     if sub.empty:
@@ -3678,7 +3895,8 @@ def render_region_map_block(ctx: PageContext) -> None:  # override with matrix-b
     df_ranked = agg.sort_values("Значение", ascending=percent_metric and metric_key in METRICS_SMALLER_IS_BETTER)
     if view_mode == "Лента лидеров":
         df_ranked = df_ranked.copy()
-        df_ranked["Ключ"] = df_ranked["Регион"] + " · " + df_ranked["Подразделение"].fillna("—")
+        # Регион — категория, Подразделение — string: склеиваем как обычные строки
+        df_ranked["Ключ"] = df_ranked["Регион"].astype(str) + " · " + df_ranked["Подразделение"].fillna("—").astype(str)
         df_ranked["Значение, отображение"] = df_ranked["Значение"].apply(
             lambda v: fmt_pct(v) if percent_metric else format_rub(v)
         )
@@ -3761,9 +3979,9 @@ def render_comparison_page(ctx: PageContext) -> None:
 
 
 def _month_to_quarter(month: str) -> str:
-    if month not in ORDER:
+    idx = _ORDER_POS.get(month)
+    if idx is None:
         return month
-    idx = ORDER.index(month)
     quarter = (idx // 3) + 1
     return f"Q{quarter}"
 
@@ -3965,7 +4183,7 @@ def render_cohort_page(ctx: PageContext) -> None:
             np.clip(100 - merged["Доля новых, %"], 0, 100),
             np.nan,
         )
-        region_order = merged.groupby("Регион")["Новые клиенты"].sum().sort_values(ascending=False).index.tolist()
+        region_order = merged.groupby("Регион", observed=True)["Новые клиенты"].sum().sort_values(ascending=False).index.tolist()
         default_regions = region_order[: min(5, len(region_order))]
         selected_regions = st.multiselect(
             "Регионы для сравнения",
@@ -4012,7 +4230,7 @@ def render_cohort_page(ctx: PageContext) -> None:
             st.plotly_chart(line_ret, use_container_width=True, key="cohort_ret_compare")
 
         summary = (
-            panel.groupby("Регион", as_index=False)[["Новые клиенты", "Активная база", "Доля новых, %", "Удержание, %"]]
+            panel.groupby("Регион", as_index=False, observed=True)[["Новые клиенты", "Активная база", "Доля новых, %", "Удержание, %"]]
             .agg({"Новые клиенты": "sum", "Активная база": "mean", "Доля новых, %": "mean", "Удержание, %": "mean"})
             .sort_values("Новые клиенты", ascending=False)
         )
@@ -4772,6 +4990,7 @@ def ai_analysis_block_comparison(df_a: pd.DataFrame, df_b: pd.DataFrame, regions
             except Exception as exc:
                 st.error(str(exc))
 
+@lru_cache(maxsize=1024)
 def y_fmt_for_metric(m: str) -> tuple[str, str]:
     """Возвращает (plotly tickformat, suffix_for_hover)"""
     if ("руб" in m) or (m == Metrics.DEBT.value):
@@ -4790,56 +5009,106 @@ def _flatten_columns(df: pd.DataFrame) -> pd.DataFrame:
     df.columns.name = None
     return df
 
+# Признаки НЮЗ / ЮЗ (учитываем возможные опечатки и пробелы)
+NUZ_PATTERN = re.compile(r"\bн\s*ю\s*з\b|нюз")
+YUZ_PATTERN = re.compile(r"\bю\s*з\b|юз")
+# Оба признака одной альтернацией: какая группа сработала, та и категория
+_CAT_RE = re.compile(rf"(?P<nuz>{NUZ_PATTERN.pattern})|(?P<uz>{YUZ_PATTERN.pattern})")
+_CODE_RE = re.compile(r"№\s*(\d+)")
+
 def detect_category(raw_text: str) -> str:
     """Определяем, к чему относится строка: НЮЗ / ЮЗ / Общее (без явной метки)."""
-    s = (raw_text or "").lower()
-    # Признаки НЮЗ / ЮЗ (учитываем возможные опечатки и пробелы)
-    has_nuz = re.search(r"\bн\s*ю\s*з\b|нюз", s) is not None
-    has_yuz = re.search(r"\bю\s*з\b|юз", s) is not None
+    # регистр и крайние пробелы на результат не влияют — приводим до кэша, чтобы чаще попадать
+    return _detect_category_norm((raw_text or "").lower().strip())
+
+@lru_cache(maxsize=2048)
+def _detect_category_norm(s: str) -> str:
+    # оба признака требуют «з» — без неё regex не нужен
+    if "з" not in s:
+        return "Общее"
+    has_nuz = NUZ_PATTERN.search(s) is not None
+    has_yuz = YUZ_PATTERN.search(s) is not None
     if has_nuz and not has_yuz:
         return "НЮЗ"
     if has_yuz and not has_nuz:
         return "ЮЗ"
     return "Общее"
 
+def detect_category_series(texts: pd.Series) -> pd.Series:
+    """detect_category для целой колонки: каждая уникальная строка разбирается один раз."""
+    return texts.fillna("").astype(str).map(detect_category).astype(object)
+
+def nuz_category_mask(cat: pd.Series) -> np.ndarray:
+    """Строки категории НЮЗ: нормализуем только уникальные значения, маска — одним isin (для категорий — по кодам)."""
+    labels = [c for c in cat.dropna().unique() if str(c).strip().lower() == "нюз"]
+    return cat.isin(labels).to_numpy()
+
+@lru_cache(maxsize=4096)
 def normalize_metric_name(name: str) -> str:
+    # Одни и те же подписи повторяются во всех подразделениях — кэшируем сопоставление
     if name is None:
         return ""
     key = _normalize_metric_label(name)
     return METRIC_ALIAS_MAP.get(key, "")
 
+RUS_MONTHS = {
+    "январь": "Январь", "янв": "Январь", "февраль": "Февраль", "фев": "Февраль",
+    "март": "Март", "мар": "Март", "апрель": "Апрель", "апр": "Апрель",
+    "май": "Май", "июнь": "Июнь", "июль": "Июль", "август": "Август", "авг": "Август",
+    "сентябрь": "Сентябрь", "сен": "Сентябрь", "октябрь": "Октябрь", "окт": "Октябрь",
+    "ноябрь": "Ноябрь", "ноя": "Ноябрь", "декабрь": "Декабрь", "дек": "Декабрь",
+    "итого": "Итого", "итог": "Итого"
+}
+
+_MONTH_SUFFIX_RE = re.compile(r"[\d\sггод]+$")
+
 def normalize_month_token(x) -> str | None:
-    RUS_MONTHS = {
-        "январь": "Январь", "янв": "Январь", "февраль": "Февраль", "фев": "Февраль",
-        "март": "Март", "мар": "Март", "апрель": "Апрель", "апр": "Апрель",
-        "май": "Май", "июнь": "Июнь", "июль": "Июль", "август": "Август", "авг": "Август",
-        "сентябрь": "Сентябрь", "сен": "Сентябрь", "октябрь": "Октябрь", "окт": "Октябрь",
-        "ноябрь": "Ноябрь", "ноя": "Ноябрь", "декабрь": "Декабрь", "дек": "Декабрь",
-        "итого": "Итого", "итог": "Итого"
-    }
     if x is None: return None
     s = str(x).strip().lower().replace(".", "")
-    s = re.sub(r"[\d\sггод]+$", "", s).strip()
+    s = _MONTH_SUFFIX_RE.sub("", s).strip()
     return RUS_MONTHS.get(s)
 
-@st.cache_data
+COLOR_PALETTE = list(dict.fromkeys(qcolors.Plotly + qcolors.D3 + qcolors.Set3 + qcolors.Dark24 + qcolors.Light24))
+
+@lru_cache(maxsize=8)
 def consistent_color_map(keys: Tuple[str, ...]) -> Dict[str, str]:
-    pal = (qcolors.Plotly + qcolors.D3 + qcolors.Set3 + qcolors.Dark24 + qcolors.Light24)
-    return {k: pal[i % len(pal)] for i, k in enumerate(sorted(map(str, keys)))}
+    """
+    Цвет по crc32 имени: одинаков между сессиями и не зависит ни от порядка, ни от состава ключей
+    (совпадение цветов у пары регионов возможно — зато цвет региона не меняется при смене выборки).
+    Набор регионов между перезапусками тот же — словарь кэшируется; вызывающие его не меняют.
+    """
+    pal = COLOR_PALETTE
+    return {k: pal[zlib.crc32(k.encode("utf-8")) % len(pal)] for k in map(str, keys)}
+
+def _month_tokens_frame(head: pd.DataFrame) -> pd.DataFrame:
+    """normalize_month_token для всех ячеек сразу: метка месяца или NaN, колонки — позиции."""
+    cells = head.to_numpy(dtype=object)
+    s = (
+        pd.Series(cells.ravel()).astype("string")
+          .str.strip().str.lower()
+          .str.replace(".", "", regex=False)
+          .str.replace(_MONTH_SUFFIX_RE, "", regex=True)
+          .str.strip()
+    )
+    return pd.DataFrame(s.map(RUS_MONTHS).to_numpy(dtype=object).reshape(cells.shape))
 
 def detect_month_header(df: pd.DataFrame, max_header_rows: int = 15) -> tuple[int, list[tuple[int, str]]] | None:
-    for r in range(min(max_header_rows, len(df))):
-        row = df.iloc[r, :].tolist()
-        month_cols = [(j, m) for j, val in enumerate(row) if (m := normalize_month_token(val)) in ORDER_WITH_TOTAL]
-        if len({m for _, m in month_cols if m in ORDER}) >= 3:
-            cleaned = []
-            last_m = None
-            for j, m in sorted(month_cols, key=lambda x: x[0]):
-                if m != last_m:
-                    cleaned.append((j, m))
-                    last_m = m
-            return r, cleaned
-    return None
+    head = df.head(max_header_rows)
+    if head.empty:
+        return None
+    tokens = _month_tokens_frame(head)
+    counts = tokens.where(tokens.isin(ORDER)).nunique(axis=1).to_numpy()
+    hits = counts >= 3
+    if not hits.any():
+        return None
+    r = int(hits.argmax())
+    cleaned = []
+    last_m = None
+    for j, m in enumerate(tokens.iloc[r].tolist()):
+        if isinstance(m, str) and m != last_m:
+            cleaned.append((j, m))
+            last_m = m
+    return r, cleaned
 
 def guess_data_sheet(xl: pd.ExcelFile) -> str:
     if "TDSheet" in xl.sheet_names: return "TDSheet"
@@ -4854,60 +5123,243 @@ def guess_data_sheet(xl: pd.ExcelFile) -> str:
             continue
     return best or xl.sheet_names[0]
 
+def guess_data_sheet_wb(wb) -> str:
+    if "TDSheet" in wb.sheetnames: return "TDSheet"
+    best, best_score = None, -1
+    for sh in wb.sheetnames:
+        try:
+            ws = wb[sh]
+            ws.reset_dimensions()
+            tmp = pd.DataFrame(list(ws.iter_rows(max_row=15, values_only=True)))
+            det = detect_month_header(tmp)
+            sc = len(det[1]) if det else 0
+            if sc > best_score: best, best_score = sh, sc
+        except Exception:
+            continue
+    return best or wb.sheetnames[0]
+
+def read_data_sheet(file_bytes: bytes) -> tuple[str, pd.DataFrame]:
+    """Если есть python-calamine — читаем им (Rust, любые xlsx/xls/xlsb);
+    иначе xlsx потоково через openpyxl read_only, старые xls — через pandas/xlrd."""
+    if HAS_CALAMINE:
+        try:
+            xl = pd.ExcelFile(BytesIO(file_bytes), engine="calamine")
+            sheet = guess_data_sheet(xl)
+            return sheet, xl.parse(sheet, header=None)
+        except Exception:
+            pass
+    try:
+        wb = load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+    except Exception:
+        xl = pd.ExcelFile(BytesIO(file_bytes))
+        sheet = guess_data_sheet(xl)
+        return sheet, xl.parse(sheet, header=None)
+    try:
+        sheet = guess_data_sheet_wb(wb)
+        ws = wb[sheet]
+        # read_only верит размерам из заголовка листа — у выгрузок они бывают неверными
+        ws.reset_dimensions()
+        rows = list(ws.iter_rows(values_only=True))
+    finally:
+        wb.close()
+    return sheet, pd.DataFrame(rows)
+
+# Шум в имени файла: служебные слова | годы 20xx | диапазоны месяцев «1-8», «01_08» | числовые хвосты
+_STEM_NOISE_RE = re.compile(
+    r"(?i)\b(?:итого|подразделени[яе]|расширенн\w*|данн\w*)\b"
+    r"|\b20\d{2}\b"
+    r"|\b\d{1,2}\s*[-–—_]\s*\d{1,2}\b"
+    r"|[ _\-–—]*\d+\b"
+)
+_MULTISPACE_RE = re.compile(r"\s{2,}")
+_TOTALS_PREFIX_RE = re.compile(r"^\s*итого\s+", re.IGNORECASE)
+_KRASNODAR_RE = re.compile(r"(?i)^(кк|краснодар)")
+_SPB_RE = re.compile(r"(?i)санкт(?:-|\s*)петербург|санкт")
+_REGION_TAIL_RE = re.compile(r"[·.]+$")
+
+def clean_region_name(name: str) -> str:
+    """Нормализация «Регион» в общем датасете: двойные пробелы, хвостовые «·»/«.», пробелы по краям."""
+    return _REGION_TAIL_RE.sub("", _MULTISPACE_RE.sub(" ", name)).strip()
+
 def _canonical_region_from_file(stem: str, df_head: pd.DataFrame) -> str:
     # 1) Пытаемся вытащить заголовок "Итого <Регион>" из тела файла
     try:
         c0 = df_head.iloc[1, 0]
         if isinstance(c0, str) and c0.strip().lower().startswith("итого"):
-            reg = re.sub(r"^\s*итого\s+", "", c0.strip(), flags=re.IGNORECASE)
-            return re.sub(r"\s{2,}", " ", reg).strip(" _-·.")
+            reg = _TOTALS_PREFIX_RE.sub("", c0.strip())
+            return _MULTISPACE_RE.sub(" ", reg).strip(" _-·.")
     except Exception:
         pass
 
-    # 2) Чистим имя файла
-    s = stem
-    # убираем служебные слова
-    s = re.sub(r"(?i)\b(итого|подразделени[яе]|расширенн\w*|данн\w*)\b", "", s)
-    # убираем любые годы 20xx
-    s = re.sub(r"\b20\d{2}\b", "", s)
-    # убираем диапазоны месяцев вида "1-8", "01_08", "1–8"
-    s = re.sub(r"\b\d{1,2}\s*[-–—_]\s*\d{1,2}\b", "", s)
-    # убираем одиночные числовые хвосты
-    s = re.sub(r"[ _\-–—]*\d+\b", "", s)
+    # 2) Чистим имя файла одним проходом
+    s = _STEM_NOISE_RE.sub("", stem)
     # приводим пробелы и обрезаем мусор
-    s = re.sub(r"\s{2,}", " ", s).strip(" _-·.")
+    s = _MULTISPACE_RE.sub(" ", s).strip(" _-·.")
     # кастомные нормализации
-    if re.match(r"(?i)^(кк|краснодар)", s): s = "Краснодарский край"
-    if re.fullmatch(r"(?i)санкт(?:-|\s*)петербург|санкт", s): s = "Санкт-Петербург"
+    if _KRASNODAR_RE.match(s): s = "Краснодарский край"
+    if _SPB_RE.fullmatch(s): s = "Санкт-Петербург"
     return s or stem
 
-@st.cache_data(show_spinner="Читаю и разбираю файлы…")
+_is_text_cell = np.frompyfunc(lambda v: isinstance(v, str), 1, 1)
+_is_number_cell = np.frompyfunc(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool), 1, 1)
+
+def _coerce_text_numbers(s: pd.Series) -> np.ndarray:
+    """Строковые ячейки → float: %, пробелы/NBSP, тысячные и десятичные разделители."""
+    s = s.astype("string").str.strip()
+    pct = s.str.endswith("%").fillna(False).astype(bool)
+    s = s.mask(pct, s.str.slice(stop=-1))
+    s = s.str.replace("\u00A0", "", regex=False).str.replace(" ", "", regex=False)
+    commas = s.str.count(",").fillna(0)
+    dots = s.str.count(r"\.").fillna(0)
+    thousands_dot = (~pct & (commas == 1) & (dots > 1)).astype(bool)
+    thousands_comma = (~pct & (commas > 1) & (dots <= 1)).astype(bool)
+    decimal_comma = (pct | ((commas == 1) & (dots == 0))).astype(bool)
+    s = (
+        s.mask(decimal_comma, s.str.replace(",", ".", regex=False))
+         .mask(thousands_dot, s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+         .mask(thousands_comma, s.str.replace(",", "", regex=False))
+    )
+    return pd.to_numeric(s, errors="coerce").astype("Float64").to_numpy(dtype=float, na_value=np.nan)
+
+def coerce_number_block(values: np.ndarray) -> np.ndarray:
+    """Приводит блок ячеек месяцев к float: числа берём как есть, через строковый разбор идут только текстовые ячейки."""
+    values = np.asarray(values, dtype=object)
+    if values.size == 0:
+        return np.empty(values.shape, dtype=float)
+    flat = values.ravel()
+    out = np.full(flat.shape, np.nan)
+    is_number = _is_number_cell(flat).astype(bool)
+    out[is_number] = flat[is_number].astype(float)
+    is_text = _is_text_cell(flat).astype(bool)
+    if is_text.any():
+        out[is_text] = _coerce_text_numbers(pd.Series(flat[is_text]))
+    return out.reshape(values.shape)
+
+def _text_cells(values: np.ndarray) -> pd.DataFrame:
+    """Непустые строковые ячейки (обрезанные); числа, пустые и прочее — NA."""
+    if values.size == 0:
+        return pd.DataFrame(index=range(values.shape[0]), dtype="string")
+    is_text = _is_text_cell(values).astype(bool)
+    text = pd.DataFrame(np.where(is_text, values, None)).astype("string")
+    return text.apply(lambda col: col.str.strip()).replace("", pd.NA)
+
+def _extract_metric_rows(left: np.ndarray, values: np.ndarray, month_labels: list[str]) -> pd.DataFrame:
+    """
+    Разбор тела листа целиком, без цикла по строкам.
+    left — ячейки слева от первого месяца, values — числа по колонкам месяцев (month_labels).
+    Возвращает длинную таблицу; строки с __total__=True — пересчитанный «Итого» по строке.
+    """
+    columns = ["Код", "Подразделение", "Показатель", "Месяц", "Значение", "Категория", "__total__"]
+    text = _text_cells(left)
+    if text.shape[1] == 0:
+        return pd.DataFrame(columns=columns)
+
+    # подразделение «протягивается» вниз, метрика — самая правая текстовая ячейка до месяцев
+    branch = text[0].ffill().fillna("").astype(object)
+    # самая правая непустая ячейка строки — argmax с конца по маске (ffill(axis=1) на одной колонке тянет вниз)
+    present = text.notna().to_numpy()
+    last_col = present.shape[1] - 1 - present[:, ::-1].argmax(axis=1)
+    metric_cell = pd.Series(
+        text.to_numpy(dtype=object)[np.arange(len(text)), last_col], index=text.index, dtype=object
+    ).where(present.any(axis=1))
+    metric_name = metric_cell.map(normalize_metric_name, na_action="ignore")
+    valid = metric_name.isin(ACCEPTED_METRICS_CANONICAL).to_numpy()
+    if not valid.any():
+        return pd.DataFrame(columns=columns)
+
+    branch = branch[valid].reset_index(drop=True)
+    metric_cell = metric_cell[valid].reset_index(drop=True)
+    metric_name = metric_name[valid].reset_index(drop=True).astype(object)
+    left_blob = text[valid].reset_index(drop=True).fillna("").agg(" ".join, axis=1).str.lower()
+    values = values[valid]
+
+    # категория: метрика → подразделение → текст слева → последняя явная метка выше
+    cat = detect_category_series(metric_cell)
+    cat = cat.mask(cat.eq("Общее"), detect_category_series(branch))
+    # один проход _CAT_RE; если первой нашлась «ЮЗ», «НЮЗ» может стоять дальше — досматриваем только такие строки
+    # без «з» нет ни одного признака — regex гоняем только по строкам, где она есть
+    with_z = left_blob.str.contains("з", regex=False, na=False)
+    found = left_blob[with_z].str.extract(_CAT_RE).reindex(left_blob.index)
+    is_nuz = found["nuz"].notna()
+    maybe = found["uz"].notna()
+    if maybe.any():
+        is_nuz[maybe] = left_blob[maybe].str.contains(NUZ_PATTERN)
+    blob_cat = pd.Series(np.nan, index=cat.index, dtype=object)
+    blob_cat[maybe] = "ЮЗ"
+    blob_cat[is_nuz] = "НЮЗ"
+    explicit = cat.where(cat.ne("Общее"), blob_cat)
+    explicit = metric_name.map(METRIC_CATEGORY_OVERRIDES).fillna(explicit)
+    sticky = {"НЮЗ"} if NUZ_ONLY else {"НЮЗ", "ЮЗ"}
+    last_cat = explicit.where(explicit.isin(sticky)).ffill().shift(1).fillna("Общее")
+    cat = explicit.fillna(last_cat)
+
+    labels = np.asarray(month_labels, dtype=object)
+    is_total_col = labels == "Итого"
+    monthly = values[:, ~is_total_col]
+    # последняя колонка «Итого» — argmax с конца, без массива индексов
+    last_total_col = len(is_total_col) - 1 - int(is_total_col[::-1].argmax())
+    raw_total = values[:, last_total_col] if is_total_col.any() else np.full(len(values), np.nan)
+    has_fact = ~np.isnan(monthly)
+    keep = has_fact.any(axis=1)
+    if NUZ_ONLY:
+        keep = keep & nuz_category_mask(cat)
+    if not keep.any():
+        return pd.DataFrame(columns=columns)
+
+    code = pd.Series("", index=branch.index, dtype=object)
+    with_no = branch.str.contains("№", regex=False)
+    code[with_no] = branch[with_no].str.extract(_CODE_RE, expand=False).fillna("")
+    meta = pd.DataFrame({
+        "Код": code,
+        "Подразделение": branch,
+        "Показатель": metric_name,
+        "Категория": cat,
+    })[keep].reset_index(drop=True)
+    monthly, raw_total, has_fact = monthly[keep], raw_total[keep], has_fact[keep]
+
+    row_idx, col_idx = np.nonzero(has_fact)
+    month_rows = meta.iloc[row_idx].assign(
+        Месяц=labels[~is_total_col][col_idx],
+        Значение=monthly[row_idx, col_idx],
+        __total__=False,
+        __row__=row_idx,
+        __seq__=col_idx,
+    )
+
+    rules = meta["Показатель"].map(aggregation_rule).to_numpy()
+    last_pos = monthly.shape[1] - 1 - np.argmax(has_fact[:, ::-1], axis=1)
+    total = np.select(
+        [rules == "sum", rules == "mean", rules == "last"],
+        [np.nansum(monthly, axis=1), np.nanmean(monthly, axis=1), monthly[np.arange(len(monthly)), last_pos]],
+        default=np.nan,
+    )
+    total = np.where(np.isnan(total) & ~np.isnan(raw_total), raw_total, total)
+    has_total = ~np.isnan(total)
+    total_rows = meta[has_total].assign(
+        Месяц="Итого",
+        Значение=total[has_total],
+        __total__=True,
+        __row__=np.flatnonzero(has_total),
+        __seq__=monthly.shape[1],
+    )
+
+    out = pd.concat([month_rows, total_rows], ignore_index=True)
+    out = out.sort_values(["__row__", "__seq__"], kind="stable", ignore_index=True)
+    return out[columns]
+
+def content_digest(data: bytes) -> str:
+    """Короткий отпечаток содержимого файла — ключ кэша вместо самих байтов."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# вызывается из потоков разбора — спиннер один, в основном потоке (main), не из воркеров
+@st.cache_data(show_spinner=False, persist="disk", hash_funcs={bytes: content_digest})
 def parse_excel(file_bytes: bytes, region_name: str, file_year: int | None = None) -> pd.DataFrame:
-    def coerce_number(x) -> float:
-        if x is None or (isinstance(x, float) and np.isnan(x)): return np.nan
-        s = str(x).strip()
-        if s in {"", "-", "—", "NA", "NaN", "nan"}: return np.nan
-        if s.endswith("%"):
-            try:
-                s = s[:-1].strip().replace("\u00A0","").replace(" ","").replace(",", ".")
-                return float(s)
-            except (ValueError, TypeError):
-                return np.nan
-        s = s.replace("\u00A0","").replace(" ","")
-        if s.count(",") == 1 and s.count(".") > 1: s = s.replace(".", "").replace(",", ".")
-        elif s.count(",") > 1 and s.count(".") <= 1: s = s.replace(",", "")
-        elif s.count(",") == 1 and s.count(".") == 0: s = s.replace(",", ".")
-        try: return float(s)
-        except (ValueError, TypeError): return np.nan
-
-    xl = pd.ExcelFile(BytesIO(file_bytes))
-    sheet = guess_data_sheet(xl)
-    df = xl.parse(sheet, header=None)
+    sheet, df = read_data_sheet(file_bytes)
 
     head = df.head(5)
     canonical_region = _canonical_region_from_file(Path(region_name).stem, head)
     first_c0 = next((str(x).strip() for x in df.iloc[:,0].dropna().tolist() if str(x).strip()), "")
-    is_totals_file = bool(re.match(r"(?i)^\s*итого\b", first_c0))
+    is_totals_file = bool(_TOTALS_RE.match(first_c0))
 
     det = detect_month_header(df)
     if not det:
@@ -4916,154 +5368,39 @@ def parse_excel(file_bytes: bytes, region_name: str, file_year: int | None = Non
     month_map = {j: m for j, m in sorted(month_cols, key=lambda x: x[0])}
     month_indices = list(month_map.keys())
     first_month_col = min(month_indices)
-
-    rows = []
-    current_branch = ""
-    last_cat = "Общее"
-    for r in range(header_row + 1, len(df)):
-        cell0 = df.iat[r, 0] if df.shape[1] > 0 else None
-        if isinstance(cell0, str) and cell0.strip():
-            current_branch = cell0.strip()
-
-        metric_cell = None
-        for c in range(first_month_col - 1, -1, -1):
-            val = df.iat[r, c]
-            if isinstance(val, str) and val.strip():
-                metric_cell = val.strip()
-                break
-        if not metric_cell:
-            continue
-
-        metric_name = normalize_metric_name(metric_cell)
-        if not metric_name:
-            continue
-
-        # ⛔️ Пропускаем строки, если метрика не из белого списка
-        if metric_name not in ACCEPTED_METRICS_CANONICAL:
-            continue
-
-        # НОВОЕ: собираем текст левых ячеек строки (все до первой колонки месяцев)
-        left_cells = []
-        for c in range(0, first_month_col):
-            val = df.iat[r, c]
-            if isinstance(val, str) and val.strip():
-                left_cells.append(val.strip())
-        left_blob = " ".join(left_cells).lower()
-
-        # Базовая категория по названию метрики
-        cat = detect_category(metric_cell)
-
-        # Если метка не найдена в самой метрике — пытаемся определить по контексту строки
-        if cat == "Общее":
-            # 1) заголовок подразделения
-            cat = detect_category(current_branch)
-            # 2) текст в левой части строки
-            if cat == "Общее":
-                if re.search(r"\bн\s*ю\s*з\b|нюз", left_blob):
-                    cat = "НЮЗ"
-                elif re.search(r"\bю\s*з\b|юз", left_blob):
-                    cat = "ЮЗ"
-                else:
-                    cat = last_cat  # 3) наследуем последнюю явную метку в блоке
-
-        override_cat = METRIC_CATEGORY_OVERRIDES.get(metric_name)
-        if override_cat:
-            cat = override_cat
-
-        if NUZ_ONLY and str(cat).strip().lower() != "нюз":
-            continue
-
-        # Обновляем «липкую» метку, если нашли явную
-        if cat in {"НЮЗ", "ЮЗ"}:
-            last_cat = cat
-
-        code_match = re.search(r"№\s*(\d+)", str(current_branch))
-        code = code_match.group(1) if code_match else ""
-
-        month_values = []
-        raw_total_value = np.nan
-        for j in month_indices:
-            month_label = month_map[j]
-            value = coerce_number(df.iat[r, j])
-            if month_label == "Итого":
-                raw_total_value = value
-                continue
-            month_values.append((month_label, value))
-
-        if not month_values:
-            continue
-
-        arr = np.array([val for _, val in month_values], dtype=float)
-        mask_fact = ~np.isnan(arr)
-        if not mask_fact.any():
-            continue
-
-        first, last = int(np.where(mask_fact)[0][0]), int(np.where(mask_fact)[0][-1])
-        clean_months: list[tuple[str, float]] = []
-        for idx, (month_label, value) in enumerate(month_values):
-            if np.isnan(value) or ((idx < first or idx > last) and (abs(value) <= 1e-12)):
-                continue
-            clean_months.append((month_label, float(value)))
-            rows.append({
-                "Регион": str(canonical_region),
-                "ИсточникФайла": "TOTALS_FILE" if is_totals_file else "BRANCHES_FILE",
-                "Код": code,
-                "Подразделение": str(current_branch),
-                "Показатель": metric_name,
-                "Месяц": month_label,
-                "Значение": float(value),
-                "Категория": cat,
-            })
-
-        if not clean_months:
-            continue
-
-        total_value = np.nan
-        series = pd.Series([val for _, val in clean_months], index=[m for m, _ in clean_months], dtype=float)
-        rule = aggregation_rule(metric_name)
-
-        if rule == "sum":
-            total_value = float(series.sum())
-        elif rule == "mean":
-            total_value = float(series.mean())
-        elif rule == "last":
-            total_value = float(series.iloc[-1])
-
-        if np.isnan(total_value) and not np.isnan(raw_total_value):
-            total_value = float(raw_total_value)
-
-        if not np.isnan(total_value):
-            rows.append({
-                "Регион": str(canonical_region),
-                "ИсточникФайла": "RECALC_TOTAL",
-                "Код": code,
-                "Подразделение": str(current_branch),
-                "Показатель": metric_name,
-                "Месяц": "Итого",
-                "Значение": float(total_value),
-                "Категория": cat,
-            })
-
-    out = pd.DataFrame(rows)
+    # дальше работаем с голым object-массивом: срезы без индексаторов pandas
+    body = df.to_numpy(dtype=object)[header_row + 1:]
+    month_values_block = coerce_number_block(body[:, month_indices])
+
+    out = _extract_metric_rows(
+        body[:, :first_month_col],
+        month_values_block,
+        [month_map[j] for j in month_indices],
+    )
     if out.empty:
         raise ValueError("Данные не распознаны.")
+    source = np.where(out["__total__"].to_numpy(), "RECALC_TOTAL", "TOTALS_FILE" if is_totals_file else "BRANCHES_FILE")
 
     if NUZ_ONLY:
-        mask_nuz = (
-            out.get("Категория")
-               .astype(str)
-               .str.strip()
-               .str.lower()
-               .eq("нюз")
-        )
-        out = out.loc[mask_nuz].copy()
+        mask_nuz = nuz_category_mask(out["Категория"])
+        out, source = out[mask_nuz], source[mask_nuz]
         if out.empty:
             raise ValueError("В файле не найдено строк с данными НЮЗ.")
 
-    out["Год"] = int(file_year) if file_year else pd.NA
-    out["Месяц"] = pd.Categorical(out["Месяц"].astype(str), categories=ORDER_WITH_TOTAL, ordered=True)
-    for c in ["Регион", "Подразделение", "Показатель", "Код", "ИсточникФайла", "Категория"]:
-        out[c] = out[c].astype("string")
+    # Итоговая таблица собирается одним конструктором по колонкам, сразу с нужными dtype;
+    # малокардинальные метки — категории: isin/== идут по кодам
+    out = pd.DataFrame({
+        "Регион": pd.Categorical(np.full(len(out), str(canonical_region), dtype=object)),
+        "ИсточникФайла": pd.Categorical(source),
+        "Код": out["Код"].astype("category"),
+        "Подразделение": out["Подразделение"].astype(TEXT_DTYPE),
+        "Показатель": out["Показатель"].astype("category"),
+        "Месяц": pd.Categorical(out["Месяц"].astype(str), categories=ORDER_WITH_TOTAL, ordered=True),
+        "Значение": out["Значение"],
+        "Категория": out["Категория"].astype("category"),
+        "Год": int(file_year) if file_year else pd.NA,
+        TOTALS_FLAG_COL: totals_flag(out["Подразделение"]),
+    }, index=out.index)
     return out
 
 def apply_economic_derivatives(df: pd.DataFrame) -> pd.DataFrame:
@@ -5071,116 +5408,137 @@ def apply_economic_derivatives(df: pd.DataFrame) -> pd.DataFrame:
     if SIMPLE_MODE:
         return df
 
-    out = df.copy()
+    # новые колонки копим в словаре: копия таблицы — только если действительно что-то добавляем
+    new_cols: Dict[str, pd.Series] = {}
+    def has(col):
+        return col in df.columns or col in new_cols
     def div(a,b,scale=1.0):
-        return (pd.to_numeric(out.get(a), errors="coerce") /
-                pd.to_numeric(out.get(b), errors="coerce").replace(0, np.nan)) * scale
+        num = new_cols[a] if a in new_cols else df.get(a)
+        den = new_cols[b] if b in new_cols else df.get(b)
+        return (pd.to_numeric(num, errors="coerce") /
+                pd.to_numeric(den, errors="coerce").replace(0, np.nan)) * scale
 
-    if Metrics.AVG_LOAN.value not in out and {Metrics.LOAN_ISSUE.value, Metrics.LOAN_ISSUE_UNITS.value} <= set(out.columns):
-        out[Metrics.AVG_LOAN.value] = div(Metrics.LOAN_ISSUE.value, Metrics.LOAN_ISSUE_UNITS.value)
+    if not has(Metrics.AVG_LOAN.value) and has(Metrics.LOAN_ISSUE.value) and has(Metrics.LOAN_ISSUE_UNITS.value):
+        new_cols[Metrics.AVG_LOAN.value] = div(Metrics.LOAN_ISSUE.value, Metrics.LOAN_ISSUE_UNITS.value)
 
-    if Metrics.MARKUP_PCT.value not in out and {Metrics.MARKUP_AMOUNT.value, Metrics.REVENUE.value} <= set(out.columns):
-        out[Metrics.MARKUP_PCT.value] = div(Metrics.MARKUP_AMOUNT.value, Metrics.REVENUE.value, 100.0)
+    if not has(Metrics.MARKUP_PCT.value) and has(Metrics.MARKUP_AMOUNT.value) and has(Metrics.REVENUE.value):
+        new_cols[Metrics.MARKUP_PCT.value] = div(Metrics.MARKUP_AMOUNT.value, Metrics.REVENUE.value, 100.0)
 
-    if Metrics.RISK_SHARE.value not in out and {Metrics.BELOW_LOAN.value, Metrics.REVENUE.value} <= set(out.columns):
-        out[Metrics.RISK_SHARE.value] = div(Metrics.BELOW_LOAN.value, Metrics.REVENUE.value, 100.0)
+    if not has(Metrics.RISK_SHARE.value) and has(Metrics.BELOW_LOAN.value) and has(Metrics.REVENUE.value):
+        new_cols[Metrics.RISK_SHARE.value] = div(Metrics.BELOW_LOAN.value, Metrics.REVENUE.value, 100.0)
 
-    if Metrics.YIELD.value not in out and {Metrics.PENALTIES_RECEIVED.value, Metrics.LOAN_ISSUE.value} <= set(out.columns):
-        out[Metrics.YIELD.value] = div(Metrics.PENALTIES_RECEIVED.value, Metrics.LOAN_ISSUE.value, 100.0)
+    if not has(Metrics.YIELD.value) and has(Metrics.PENALTIES_RECEIVED.value) and has(Metrics.LOAN_ISSUE.value):
+        new_cols[Metrics.YIELD.value] = div(Metrics.PENALTIES_RECEIVED.value, Metrics.LOAN_ISSUE.value, 100.0)
 
-    return out
+    return df.assign(**new_cols) if new_cols else df
 
 def normalize_percent_series(s: pd.Series) -> pd.Series:
     x = pd.to_numeric(s, errors="coerce")
-    clean = x.dropna()
-    if not clean.empty and (clean.abs() <= 2).all(): x = x * 100.0
+    # доли (все |v| ≤ 2) переводим в проценты; решение — одна редукция nanmax по массиву
+    arr = np.abs(x.to_numpy(dtype="float64", na_value=np.nan))
+    if (~np.isnan(arr)).any() and np.nanmax(arr) <= 2: x = x * 100.0
     return x
 
 def strip_totals_rows(df: pd.DataFrame) -> pd.DataFrame:
-    mask = ~df["Подразделение"].str.contains(r"^\s*итого\b", case=False, na=False)
-    return df.loc[mask]
+    # флаг готов с загрузки — фильтруем голым numpy-массивом, без regex и выравнивания индекса
+    return df.loc[~totals_row_mask(df).to_numpy()]
 
-@st.cache_data
 def get_aggregated_data(df_raw: pd.DataFrame, regions: Tuple[str, ...], months: Tuple[str, ...]) -> pd.DataFrame:
-    df = strip_totals_rows(df_raw)
+    # кэш ключуется коротким df_id, а не хэшированием всего df_raw на каждом вызове
+    return _aggregated_data(frame_id(df_raw), df_raw, regions, months)
+
+@st.cache_data
+def _aggregated_data(df_id: str, _df_raw: pd.DataFrame, regions: Tuple[str, ...], months: Tuple[str, ...]) -> pd.DataFrame:
+    df = strip_totals_rows(_df_raw)
     sub = df[df["Регион"].isin(regions) & df["Месяц"].isin(months)]
     if sub.empty: return pd.DataFrame()
-    all_entities_df = (sub[["Регион", "Подразделение"]].drop_duplicates().sort_values(by=["Регион", "Подразделение"]).set_index(["Регион", "Подразделение"]))
-
-    # --- суммы ---
-    df_sum = (sub[sub["Показатель"].isin(METRICS_SUM)]
-              .groupby(["Регион","Подразделение","Показатель"], observed=True)["Значение"]
-              .sum().unstack())
-    df_sum = _flatten_columns(df_sum)
-    result = all_entities_df.join(df_sum, how="left")
-
-    # --- last (снимки на конец периода) ---
-    if METRICS_LAST:
-        snap = sub[sub["Показатель"].isin(METRICS_LAST)].copy()
-        if not snap.empty:
-            # Важно: 'Месяц' — упорядоченная категориальная, сортируем и берём последнее
-            snap['Месяц'] = pd.Categorical(snap['Месяц'].astype(str), categories=ORDER, ordered=True)
-            snap = snap.sort_values(["Регион","Подразделение","Показатель","Месяц"])
-            df_last = (snap.groupby(["Регион","Подразделение","Показатель"], observed=True)
-                            .tail(1)
-                            .set_index(["Регион","Подразделение","Показатель"])["Значение"]
-                            .unstack())
-            df_last = _flatten_columns(df_last)
-            result = result.join(df_last, how="left")
-
-    # --- средние ---
-    metrics_to_average = METRICS_MEAN - ({Metrics.RISK_SHARE.value} if not SIMPLE_MODE else set())
+    result = (sub[["Регион", "Подразделение"]].drop_duplicates().sort_values(by=["Регион", "Подразделение"]).set_index(["Регион", "Подразделение"]))
 
-    if metrics_to_average:
-        df_mean = (sub[sub["Показатель"].isin(metrics_to_average)]
-                   .groupby(["Регион","Подразделение","Показатель"], observed=True)["Значение"]
-                   .mean().unstack())
-        df_mean = _flatten_columns(df_mean)
-        for metric in metrics_to_average:
-            if metric in df_mean.columns:
-                result[metric] = df_mean[metric]
+    # Правило на показатель: суммы, снимки на конец периода (last), средние
+    metrics_to_average = METRICS_MEAN - ({Metrics.RISK_SHARE.value} if not SIMPLE_MODE else set())
+    kind_map = {m: "sum" for m in METRICS_SUM} | {m: "last" for m in METRICS_LAST} | {m: "mean" for m in metrics_to_average}
+    kind = sub["Показатель"].map(kind_map).astype(object)
+    sub = sub[kind.notna().to_numpy()]
+    if not sub.empty:
+        # Один groupby на все три правила. Снимок — строка с наибольшим кодом месяца
+        # (упорядоченная категориальная), при равенстве — более поздняя: idxmax без сортировки
+        keys = ["Регион", "Подразделение", "Показатель"]
+        month_key = sub["Месяц"].cat.codes.to_numpy(dtype=np.int64) * len(sub) + np.arange(len(sub))
+        grouped = sub.assign(__mkey__=month_key).groupby(keys, observed=True)
+        stats = pd.DataFrame({
+            "sum": grouped["Значение"].sum(),
+            "mean": grouped["Значение"].mean(),
+        })
+        stats["last"] = sub.loc[grouped["__mkey__"].idxmax().to_numpy(), "Значение"].to_numpy()
+        rule = stats.index.get_level_values("Показатель").map(kind_map).to_numpy(dtype=object)
+        picked = pd.Series(
+            np.select([rule == "sum", rule == "last"], [stats["sum"], stats["last"]], default=stats["mean"]),
+            index=stats.index,
+        )
+        wide = _flatten_columns(picked.unstack("Показатель"))
+        # порядок колонок как раньше: суммы, снимки, затем средние
+        present = set(map(str, stats.index.get_level_values("Показатель")))
+        ordered = [c for c in wide.columns if c in present and kind_map[c] == "sum"]
+        ordered += [c for c in wide.columns if c in present and kind_map[c] == "last"]
+        ordered += [m for m in metrics_to_average if m in present]
+        result = result.join(wide[ordered], how="left")
 
-    result = apply_economic_derivatives(result) # Не будет ничего делать в SIMPLE_MODE
+    if not SIMPLE_MODE:
+        result = apply_economic_derivatives(result)
 
     return result.reset_index()
 
 
-@st.cache_data
 def get_monthly_pivoted_data(df_raw: pd.DataFrame, regions: Tuple[str, ...], months: Tuple[str, ...], raw_only: bool = False) -> pd.DataFrame:
-    df = strip_totals_rows(df_raw)
+    # кэш по df_id, как у get_aggregated_data: без хэширования df_raw на каждом вызове
+    return _monthly_pivoted(frame_id(df_raw), df_raw, tuple(regions), tuple(months), raw_only)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _monthly_pivoted(df_id: str, _df_raw: pd.DataFrame, regions: Tuple[str, ...], months: Tuple[str, ...], raw_only: bool) -> pd.DataFrame:
+    df = strip_totals_rows(_df_raw)
     sub = df[df["Регион"].isin(regions) & df["Месяц"].isin(months)]
     if sub.empty: return pd.DataFrame()
-    pivot = sub.pivot_table(index=["Регион","Подразделение","Месяц"], columns="Показатель", values="Значение", aggfunc="sum", observed=False)
-    pivot = _flatten_columns(pivot).reset_index()
-
-    if not raw_only:
+    # groupby().sum().unstack() вместо pivot_table: без декартова произведения по всем категориям.
+    # Форма таблицы прежняя: у каждого подразделения — все выбранные месяцы, пустые клетки — нули
+    keys = ["Регион", "Подразделение", "Месяц"]
+    pivot = (sub.groupby(keys + ["Показатель"], observed=True)["Значение"]
+                .sum().unstack("Показатель", fill_value=0))
+    month_order = [m for m in ORDER_WITH_TOTAL if m in set(months)]
+    pairs = pivot.index.droplevel("Месяц").unique()
+    full = pd.MultiIndex.from_arrays([
+        pairs.get_level_values("Регион").repeat(len(month_order)),
+        pairs.get_level_values("Подразделение").repeat(len(month_order)),
+        pd.Categorical(np.tile(month_order, len(pairs)), dtype=sub["Месяц"].dtype),
+    ], names=keys)
+    pivot = _flatten_columns(pivot.reindex(full, fill_value=0)).reset_index()
+
+    if not raw_only and not SIMPLE_MODE:
         pivot = apply_economic_derivatives(pivot)
 
     for col in [Metrics.ILLIQUID_BY_COUNT_PCT.value, Metrics.ILLIQUID_BY_VALUE_PCT.value, Metrics.YIELD.value, Metrics.MARKUP_PCT.value]:
         if col in pivot.columns: pivot[col] = normalize_percent_series(pivot[col])
     return pivot
 
-@st.cache_data
 def month_totals_matrix(df_raw: pd.DataFrame, regions: Tuple[str, ...], metric: str) -> pd.DataFrame:
     """
     Возвращает матрицу Регион × Месяц с помесячными значениями из строк «Итого по месяцу».
     Никаких сумм по филиалам — только то, что лежит в файле в строках «Итого».
+    Своего кэша нет: общая раскладка уже кэширована по df_id в get_monthly_totals_from_file,
+    а st.cache_data здесь хэшировал бы всю df_raw на каждом вызове.
     """
     dfm = get_monthly_totals_from_file(df_raw, regions, metric)
     if dfm.empty:
         return pd.DataFrame(columns=["Регион","Месяц","Значение"])
-    return dfm.copy()
+    return dfm
 
 def _postprocess_monthly_df(df: pd.DataFrame) -> pd.DataFrame:
     if df is None or df.empty:
         return pd.DataFrame(columns=["Регион","Месяц","Значение"])
-    out = df.copy()
-    keep = [c for c in out.columns if c in {"Регион","Месяц","Значение"}]
-    out = out[keep]
-    out["Регион"] = out["Регион"].astype("string")
-    out["Месяц"] = out["Месяц"].astype(str)
-    out = out[out["Месяц"].isin(ORDER)]
-    out = (out.groupby(["Регион","Месяц"], as_index=False)["Значение"].sum())
+    keep = [c for c in df.columns if c in {"Регион","Месяц","Значение"}]
+    # фильтр по категориальному «Месяц» без приведения к строкам; к str — только оставшиеся строки
+    out = df.loc[df["Месяц"].isin(ORDER), keep]
+    out = out.assign(Регион=out["Регион"].astype("string"), Месяц=out["Месяц"].astype(str))
+    out = (out.groupby(["Регион","Месяц"], as_index=False, observed=True)["Значение"].sum())
     return out
 
 @st.cache_data
@@ -5190,15 +5548,25 @@ def number_column_config(title: str, money=False, percent=False, days=False):
     if days: return st.column_config.NumberColumn(f"{title}, дн.", help="Дни", format="%.2f")
     return st.column_config.NumberColumn(title, format="%.2f")
 
+@lru_cache(maxsize=1024)
+def _fmt_kind(col: str) -> str:
+    """Формат числовой колонки по названию показателя: money / percent / days / num."""
+    if "руб" in col:
+        return "money"
+    low = col.lower()
+    if "%" in col or "наценк" in low or "доля" in low or col == Metrics.YIELD.value:
+        return "percent"
+    if "дней" in col:
+        return "days"
+    return "num"
+
 def default_column_config(df: pd.DataFrame) -> dict:
     cfg = {}
     for c in df.columns:
-        s = str(c)
-        is_money = "руб" in s
-        is_percent = s.endswith("(%)") or "наценк" in s.lower() or "доля" in s.lower() or s == Metrics.YIELD.value
-        is_days = "дней" in s
         if pd.api.types.is_numeric_dtype(df[c]):
-            cfg[s] = number_column_config(s, money=is_money, percent=is_percent, days=is_days)
+            s = str(c)
+            kind = _fmt_kind(s)
+            cfg[s] = number_column_config(s, money=kind == "money", percent=kind == "percent", days=kind == "days")
     return cfg
 
 def kpi_block(df_all: pd.DataFrame, regions: list[str], months_range: list[str], all_available_months: list[str], strict_mode: bool):
@@ -5218,7 +5586,7 @@ def kpi_block(df_all: pd.DataFrame, regions: list[str], months_range: list[str],
             txt = f"{value:,.0f}".replace(",", " ")
         col.metric(title, txt, delta=delta, delta_color=delta_color)
 
-    sub_df = df_all[(df_all["Регион"].isin(regions)) & (df_all["Месяц"].astype(str).isin(months_range))]
+    sub_df = df_all[(df_all["Регион"].isin(regions)) & (df_all["Месяц"].isin(months_range))]
     
     # какие метрики показываем в KPI-таблице по регионам
     KPI_SET_MONEY = [Metrics.REVENUE.value, Metrics.LOAN_ISSUE.value]
@@ -5229,15 +5597,8 @@ def kpi_block(df_all: pd.DataFrame, regions: list[str], months_range: list[str],
 
     if mode_view == "По регионам":
         regs_sorted = sorted(map(str, sub_df["Регион"].unique()))
-        rows = []
-        for reg in regs_sorted:
-            r = {"Регион": reg}
-            for m in KPI_COLUMNS:
-                # для KPI по регионам для снимков берём среднее за период
-                r[m] = period_value_from_itogo_for_region(df_all, reg, m, months_range, snapshots_mode="mean")
-            rows.append(r)
-
-        kpi_table = pd.DataFrame(rows).set_index("Регион")
+        # для KPI по регионам для снимков берём среднее за период
+        kpi_table = period_values_matrix(df_all, tuple(regs_sorted), tuple(KPI_COLUMNS), tuple(months_range), snapshots_mode="mean")
         # сортировка по выручке
         sort_col = Metrics.REVENUE.value if Metrics.REVENUE.value in kpi_table.columns else kpi_table.columns[0]
         kpi_table = kpi_table.sort_values(by=sort_col, ascending=False)
@@ -5374,18 +5735,12 @@ def summary_block(agg_data, df_all, regions, months_range, all_available_months,
     raw_metrics = [m for m in sorted(sub["Показатель"].dropna().unique()) if m not in HIDDEN_METRICS]
 
     # соберём таблицу: строки — регионы; столбцы — метрики
-    rows = []
-    for reg in sorted(map(str, sub["Регион"].unique())):
-        row = {"Регион": reg}
-        for m in raw_metrics:
-            row[m] = period_value_from_itogo_for_region(df_all, reg, m, months_range, snapshots_mode="mean")
-        rows.append(row)
-
-    if not rows:
+    summary_regions = sorted(map(str, sub["Регион"].unique()))
+    if not summary_regions:
         st.info("Нет данных для сводки по регионам.")
         return
 
-    region_summary = pd.DataFrame(rows).set_index("Регион")
+    region_summary = period_values_matrix(df_all, tuple(summary_regions), tuple(raw_metrics), tuple(months_range), snapshots_mode="mean")
 
     # сортировка по выручке, если есть
     if Metrics.REVENUE.value in region_summary.columns:
@@ -5419,14 +5774,13 @@ def nuz_active_branches(df_all: pd.DataFrame,
     """Возвращает DataFrame с колонками Регион/Подразделение только для филиалов,
     где есть ненулевые значения по НЮЗ-метрикам в выбранном окне."""
     sub = strip_totals_rows(df_all)
-    sub = sub[(sub["Регион"].isin(regions)) & (sub["Месяц"].astype(str).isin(months))]
+    sub = sub[(sub["Регион"].isin(regions)) & (sub["Месяц"].isin(months))]
     if sub.empty:
         return pd.DataFrame(columns=["Регион","Подразделение"])
-    nuz = sub[sub["Показатель"].isin(NUZ_ACTIVITY_METRICS)].copy()
-    nuz["Значение"] = pd.to_numeric(nuz["Значение"], errors="coerce").fillna(0).abs()
-    act = (nuz.groupby(["Регион","Подразделение"], observed=True)["Значение"]
-              .sum().reset_index())
-    return act[act["Значение"] > 0][["Регион","Подразделение"]]
+    # «Значение» уже числовое: активен филиал, у которого есть хоть одно ненулевое значение —
+    # одна маска и drop_duplicates вместо суммы модулей по группам
+    active = sub["Показатель"].isin(NUZ_ACTIVITY_METRICS) & sub["Значение"].abs().gt(0)
+    return sub.loc[active, ["Регион","Подразделение"]].drop_duplicates()
 
 def leaderboard_block(
     df_all: pd.DataFrame,
@@ -5450,7 +5804,7 @@ def leaderboard_block(
         value=(last_quarter[0], last_quarter[-1]),
         key=period_slider_key
     )
-    leaderboard_months = ORDER[ORDER.index(start_m): ORDER.index(end_m) + 1]
+    leaderboard_months = ORDER[_ORDER_POS[start_m]: _ORDER_POS[end_m] + 1]
 
     agg_data = get_aggregated_data(df_all, tuple(regions), tuple(leaderboard_months))
     if agg_data.empty:
@@ -5467,7 +5821,7 @@ def leaderboard_block(
         return
 
     # Сформируем пул допустимых метрик только из тех, что есть в файле
-    raw_metric_names = set(df_all["Показатель"].dropna().unique())
+    raw_metric_names = set(raw_metric_names_of(df_all))
     numeric_cols = [c for c in agg_data.columns if pd.api.types.is_numeric_dtype(agg_data[c]) and c != "Код"]
     metric_options = sorted([c for c in numeric_cols if c in raw_metric_names and c not in HIDDEN_METRICS])
 
@@ -5609,14 +5963,14 @@ def comparison_block(
             value=(available_months[-1], available_months[-1]),
             key=period_b_key
         )
-    months_a = ORDER[ORDER.index(start_a): ORDER.index(end_a)+1]
-    months_b = ORDER[ORDER.index(start_b): ORDER.index(end_b)+1]
+    months_a = ORDER[_ORDER_POS[start_a]: _ORDER_POS[end_a] + 1]
+    months_b = ORDER[_ORDER_POS[start_b]: _ORDER_POS[end_b] + 1]
     data_a = get_aggregated_data(df_all, tuple(regions), tuple(months_a))
     data_b = get_aggregated_data(df_all, tuple(regions), tuple(months_b))
     if data_a.empty or data_b.empty: st.warning("Нет данных для одного или обоих периодов."); return
     comparison_df = pd.merge(data_a, data_b, on=["Регион","Подразделение"], how="outer", suffixes=("_A","_B"))
 
-    raw_metric_names = set(df_all["Показатель"].dropna().unique())
+    raw_metric_names = set(raw_metric_names_of(df_all))
     all_metrics = sorted([c for c in data_a.columns if pd.api.types.is_numeric_dtype(data_a[c]) and c != "Код"])
     metric_options = [m for m in all_metrics if m in raw_metric_names and m not in HIDDEN_METRICS]
     if not metric_options:
@@ -5638,7 +5992,8 @@ def comparison_block(
     if col_b not in comparison_df.columns: comparison_df[col_b] = np.nan
     comparison_df["Абсолютное изменение"] = comparison_df[col_b] - comparison_df[col_a]
     comparison_df["Относительное изменение, %"] = (comparison_df["Абсолютное изменение"] / comparison_df[col_a].replace(0, np.nan)) * 100
-    is_money, is_percent, is_days = "руб" in chosen_metric, "%" in chosen_metric or "наценк" in chosen_metric.lower() or "доля" in chosen_metric.lower() or chosen_metric == Metrics.YIELD.value, "дней" in chosen_metric
+    kind = _fmt_kind(chosen_metric)
+    is_money, is_percent, is_days = kind == "money", kind == "percent", kind == "days"
     cfg = {
         col_a: number_column_config(f"{chosen_metric} (A: {start_a}-{end_a})", money=is_money, percent=is_percent, days=is_days),
         col_b: number_column_config(f"{chosen_metric} (B: {start_b}-{end_b})", money=is_money, percent=is_percent, days=is_days),
@@ -5672,6 +6027,66 @@ def comparison_block(
     action_lines = _generate_actions_for_deltas(delta_pairs, chosen_metric)
     _render_plan("Корректирующие действия", action_lines[:4])
 
+_RE_YEAR = re.compile(r"\b20\d{2}\b")
+_RE_RANGE = re.compile(r"\b\d{1,2}\s*-\s*\d{1,2}\b")
+_RE_SEP = re.compile(r"[_\.\-–—]")
+_RE_SPACES = re.compile(r"\s{2,}")
+
+@lru_cache(maxsize=1024)
+def clean_region_label(reg: str) -> str:
+    s = str(reg)
+    s = _RE_YEAR.sub("", s)         # выкинуть «2024/2025» из имени региона
+    s = _RE_RANGE.sub("", s)        # «1-8»
+    s = _RE_SEP.sub(" ", s)
+    s = _RE_SPACES.sub(" ", s).strip()
+    return s
+
+def _region_month_matrix(gp: pd.DataFrame, x_domain: list[str], region_order: list[str]) -> pd.DataFrame:
+    """
+    Месяц × Регион: суммы помесячных «Итого» одной раскладкой, выровненные по x_domain и порядку регионов.
+    Месяц-категория (суммы по подразделениям) — как прежний groupby по каждому региону: месяц без данных = 0.
+    """
+    fill = 0.0 if isinstance(gp["Месяц"].dtype, pd.CategoricalDtype) else np.nan
+    wide = (gp.groupby(["Месяц", "Регион"], observed=True)["Значение"].sum()
+              .unstack("Регион", fill_value=fill).reindex(index=x_domain, columns=region_order, fill_value=fill))
+    wide.index = pd.Index(x_domain)
+    wide.columns = pd.Index(region_order)
+    return wide
+
+def format_hover_values(values: np.ndarray, tickfmt: str, suf: str) -> np.ndarray:
+    """Подписи ховера для массива значений: формат выбирается один раз, пропуски → «—»."""
+    arr = np.asarray(values, dtype=float)
+    out = np.full(arr.shape, "—", dtype=object)
+    ok = ~np.isnan(arr)
+    if tickfmt == ",.0f":
+        fmt, thousands = f"{{:,.0f}}{suf}".format, True
+    elif tickfmt == ".2f":
+        fmt, thousands = f"{{:.2f}}{suf}".format, False
+    else:
+        fmt, thousands = f"{{:,.2f}}{suf}".format, True
+    texts = [fmt(v) for v in arr[ok].tolist()]
+    if thousands:
+        texts = [t.replace(",", " ") for t in texts]
+    out[ok] = texts
+    return out
+
+def _column_trends(y: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Линейный тренд y = k·x + b по каждому столбцу (x = 0..n-1, пропуски NaN не учитываются)
+    в закрытой форме по суммам Σx, Σy, Σxy, Σx² — вместо polyfit на каждый ряд.
+    Возвращает (k, b, число точек).
+    """
+    mask = ~np.isnan(y)
+    x = np.arange(y.shape[0], dtype=float)[:, None] * mask
+    yv = np.where(mask, y, 0.0)
+    n = mask.sum(axis=0)
+    sx, sy = x.sum(axis=0), yv.sum(axis=0)
+    sxy, sxx = (x * yv).sum(axis=0), (x * x).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        b = (sy - k * sx) / n
+    return k, b, n
+
 def dynamics_block(
     df_all: pd.DataFrame,
     regions: list[str],
@@ -5683,7 +6098,7 @@ def dynamics_block(
 ) -> None:
     st.subheader("📈 Динамика по регионам")
 
-    raw_metric_names = sorted(set(df_all["Показатель"].dropna().unique()))
+    raw_metric_names = raw_metric_names_of(df_all)
     if not raw_metric_names:
         st.warning("В файлах не найдено метрик для построения динамики.")
         return
@@ -5715,7 +6130,7 @@ def dynamics_block(
 
     for met in metrics:
         gp = get_monthly_totals_from_file(df_all, tuple(regions), met)
-        gp = gp[gp["Месяц"].astype(str).isin(months_range)]
+        gp = gp[gp["Месяц"].isin(months_range)]
         if gp.empty:
             st.info(f"Нет данных по «{met}».");
             continue
@@ -5726,9 +6141,10 @@ def dynamics_block(
         fig = go.Figure()
 
         # порядок регионов: как выбран пользователем в сайдбаре (если хотите — алфавит)
-        region_order = [r for r in regions if r in gp["Регион"].astype(str).unique()]
+        present = set(gp["Регион"].unique())
+        region_order = [r for r in regions if r in present]
         # резерв: добавим те, которых нет в выбранном списке (на случай фильтров)
-        region_order += [r for r in sorted(gp["Регион"].astype(str).unique()) if r not in region_order]
+        region_order += [r for r in sorted(present) if r not in region_order]
 
         # чтобы легенда не переворачивала порядок
         fig.update_layout(
@@ -5737,31 +6153,30 @@ def dynamics_block(
         )
 
         tickfmt, suf = y_fmt_for_metric(met)
-        def fmt_hover(v):
-            if v is None or (isinstance(v, float) and np.isnan(v)): return "—"
-            if tickfmt == ",.0f": return f"{v:,.0f}{suf}".replace(",", " ")
-            if tickfmt == ".2f": return f"{v:.2f}{suf}"
-            return f"{v:,.2f}{suf}".replace(",", " ")
-
         hovertemplate = (
             "<b>Регион: %{customdata[0]}</b><br>"
             "Месяц: %{x}<br>"
             "Значение: %{customdata[1]}<extra></extra>"
         )
 
-        any_drawn = False
+        # Одна раскладка Месяц × Регион на все серии вместо фильтра+groupby на каждый регион;
+        # подписи ховера форматируются разом по всей матрице
+        wide = _region_month_matrix(gp, x_domain, region_order)
+        hover_wide = pd.DataFrame(format_hover_values(wide.to_numpy(), tickfmt, suf),
+                                  index=wide.index, columns=wide.columns)
+
+        trend_k, trend_b, trend_n = _column_trends(wide.to_numpy(dtype=float))
+        x_pos = np.arange(len(wide.index))
+
+        traces: List[go.Scatter] = []
         deltas: List[tuple[str, float]] = []
         for rank, reg in enumerate(region_order):
-            t = gp[gp["Регион"].astype(str) == reg].groupby("Месяц", as_index=False)["Значение"].sum()
-            series = t.set_index("Месяц")["Значение"].reindex(x_domain)
+            series = wide[reg]
             if series.isna().all(): 
                 continue
-            any_drawn = True
 
             series_vals = series.values.astype(float)
-            hover_vals  = [fmt_hover(v) for v in series_vals]
-
-            fig.add_trace(go.Scatter(
+            traces.append(go.Scatter(
                 x=series.index, y=series_vals,
                 mode="lines" if fast_plot else "lines+markers",
                 name=reg,
@@ -5769,17 +6184,14 @@ def dynamics_block(
                 line=dict(color=color_map.get(reg)),
                 legendgroup=reg,
                 legendrank=rank,                  # ⬅️ порядок в легенде/ховере
-                customdata=np.column_stack([np.full(len(series), reg), hover_vals]),
+                customdata=np.column_stack([np.full(len(series), reg), hover_wide[reg].to_numpy()]),
                 hovertemplate=hovertemplate
             ))
 
             if (not fast_plot) and show_trend:
-                y_vals = series.values.astype(float); mask = ~np.isnan(y_vals)
-                if mask.sum() >= 2:
-                    x_pos = np.arange(len(series.index))
-                    k, b = np.polyfit(x_pos[mask], y_vals[mask], 1)
-                    fig.add_trace(go.Scatter(
-                        x=series.index, y=k * x_pos + b,
+                if trend_n[rank] >= 2:
+                    traces.append(go.Scatter(
+                        x=series.index, y=trend_k[rank] * x_pos + trend_b[rank],
                         mode="lines",
                         name=f"{reg} · тренд",
                         line=dict(dash="dot", width=2, color=color_map.get(reg)),
@@ -5792,6 +6204,9 @@ def dynamics_block(
             if len(clean_series) >= 2:
                 delta_val = float(clean_series.iloc[-1] - clean_series.iloc[0])
                 deltas.append((str(reg), delta_val))
+        any_drawn = bool(traces)
+        # все трассы одним вызовом: add_trace на каждую заново валидирует фигуру
+        fig.add_traces(traces)
         if not any_drawn:
             st.info(f"Для «{met}» данные есть, но после выравнивания по календарю все серии пустые (разные месяцы у источников). Выберите «Только фактические месяцы» или сузьте период.")
             continue
@@ -5809,8 +6224,9 @@ def dynamics_block(
             _render_insights(f"Выводы по {met}", [insight])
         with st.expander(f"Данные для графика «{met}»"):
             st.dataframe(
-                gp.pivot_table(index="Месяц", columns="Регион", values="Значение", aggfunc="sum", observed=False)
-                  .reindex(x_domain),
+                # та же матрица, что у графика, — без второго pivot_table
+                wide.dropna(axis=1, how="all").sort_index(axis=1)
+                    .rename_axis(index="Месяц", columns="Регион"),
                 use_container_width=True
             )
         action_lines = _generate_actions_for_deltas(deltas, met)
@@ -5831,7 +6247,7 @@ def dynamics_compare_block(
 ) -> None:
     st.subheader(f"📈 Динамика по регионам: {year_b} vs {year_a}")
 
-    raw_metric_names = sorted(set(pd.concat([df_a, df_b])["Показатель"].dropna().unique()))
+    raw_metric_names = raw_metric_names_of(df_a, df_b)
 
     base_defaults = [Metrics.REVENUE.value, Metrics.LOAN_ISSUE.value, Metrics.MARKUP_PCT.value]
     if default_metrics:
@@ -5854,13 +6270,24 @@ def dynamics_compare_block(
     if not metrics or not months_range:
         st.info("Выберите метрики и период."); return
 
+    # данные по метрикам независимы — готовим их в потоках, рисуем уже в основном
+    regs_key = tuple(regions)
+    frames = ((frame_id(df_a), df_a), (frame_id(df_b), df_b))
+    script_ctx = get_script_run_ctx()
+
+    def _prepare(met: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+        add_script_run_ctx(threading.current_thread(), script_ctx)
+        return tuple(_monthly_totals(df_id, df, regs_key, met) for df_id, df in frames)
+
+    with ThreadPoolExecutor(max_workers=min(PREP_WORKERS, len(metrics))) as pool:
+        prepared = dict(zip(metrics, pool.map(_prepare, metrics)))
+
     for met in metrics:
         rule = aggregation_rule(met)
         rule_text = 'Сумма' if rule=='sum' else 'Среднее' if rule=='mean' else 'Последний месяц'
         st.caption(f"Данные — из строк «Итого по месяцу» исходных файлов. Агрегация за период: **{rule_text}**.")
 
-        gp_a = get_monthly_totals_from_file(df_a, tuple(regions), met)
-        gp_b = get_monthly_totals_from_file(df_b, tuple(regions), met)
+        gp_a, gp_b = prepared[met]
         if gp_a.empty and gp_b.empty:
             st.info(f"Нет данных по «{met}»."); continue
 
@@ -5879,15 +6306,7 @@ def dynamics_compare_block(
             )
         )
 
-        def clean_region_label(reg: str) -> str:
-            s = str(reg)
-            s = re.sub(r"\b20\d{2}\b", "", s)         # выкинуть «2024/2025» из имени региона
-            s = re.sub(r"\b\d{1,2}\s*-\s*\d{1,2}\b", "", s)  # «1-8»
-            s = re.sub(r"[_\.\-–—]", " ", s)
-            s = re.sub(r"\s{2,}", " ", s).strip()
-            return s
-
-        all_regs = set(gp_a["Регион"].astype(str)).union(set(gp_b["Регион"].astype(str)))
+        all_regs = set().union(*(gp["Регион"].unique() for gp in (gp_a, gp_b) if not gp.empty))
         region_order = [r for r in regions if r in all_regs] + [r for r in sorted(all_regs) if r not in regions]
         label_map = {r: clean_region_label(r) for r in all_regs}
 
@@ -5895,12 +6314,6 @@ def dynamics_compare_block(
         dash_map   = {year_a: "dot", year_b: "solid"}  # «база» = пунктир, «сравнение» = сплошная
 
         tickfmt, suf = y_fmt_for_metric(met)
-        def fmt_hover(v):
-            if v is None or (isinstance(v, float) and np.isnan(v)): return "—"
-            if tickfmt == ",.0f": return f"{v:,.0f}{suf}".replace(",", " ")
-            if tickfmt == ".2f": return f"{v:.2f}{suf}"
-            return f"{v:,.2f}{suf}".replace(",", " ")
-
         hovertemplate = (
             "<b>%{customdata[0]}</b><br>"
             "Год: %{customdata[1]}<br>"
@@ -5908,55 +6321,81 @@ def dynamics_compare_block(
             "Значение: %{customdata[2]}<extra></extra>"
         )
 
+        # по матрице Месяц × Регион на год — в цикле только берём столбцы
+        wide_by_year = {
+            y: _region_month_matrix(gp, x_domain, region_order)
+            for y, gp in ((year_a, gp_a), (year_b, gp_b)) if not gp.empty
+        }
+        hover_by_year = {
+            y: pd.DataFrame(format_hover_values(w.to_numpy(), tickfmt, suf), index=w.index, columns=w.columns)
+            for y, w in wide_by_year.items()
+        }
+        trends_by_year = {
+            y: _column_trends(w.to_numpy(dtype=float)) for y, w in wide_by_year.items()
+        } if show_trend else {}
+        # регионы с данными в году — одной проверкой по матрице; остальные пары (регион, год) пропускаем сразу
+        has_data = {y: ~np.isnan(w.to_numpy(dtype=float)).all(axis=0) for y, w in wide_by_year.items()}
+
+        # много регионов × месяцев — рисуем через WebGL вместо SVG
+        scatter_cls = go.Scattergl if len(region_order) * len(wide_by_year) * len(x_domain) >= WEBGL_MIN_POINTS else go.Scatter
+
+        # подпись, цвет и группа легенды — один раз на регион, а не на каждую трассу
+        trace_defaults = {
+            reg: dict(label=label_map.get(reg, reg), color=color_map.get(reg))
+            for reg in region_order
+        }
+        year_rank = {year_b: 1, year_a: 0}
+
         delta_records: List[tuple[str, float]] = []
+        traces = []
+        xp = np.arange(len(x_domain))
         for r_rank, reg in enumerate(region_order):
+            label, color = trace_defaults[reg]["label"], trace_defaults[reg]["color"]
             for y in year_order:
-                gp = gp_a if y == year_a else gp_b
-                if gp.empty: 
-                    continue
-                t = gp[gp["Регион"].astype(str) == reg].groupby("Месяц", as_index=False)["Значение"].sum()
-                s = t.set_index("Месяц")["Значение"].reindex(x_domain)
-                if s.isna().all():
+                if y not in has_data or not has_data[y][r_rank]:
                     continue
+                s = wide_by_year[y][reg]
+                rank = r_rank * 10 + year_rank.get(y, 1)  # стабильный порядок
 
                 vals = s.values.astype(float)
-                fig.add_trace(go.Scatter(
+                customdata = np.empty((len(s), 3), dtype=object)
+                customdata[:, 0] = label
+                customdata[:, 1] = str(y)
+                customdata[:, 2] = hover_by_year[y][reg].to_numpy()
+                traces.append(scatter_cls(
                     x=s.index,
                     y=vals,
                     mode="lines+markers",
-                    name=f"{label_map.get(reg, reg)} · {y}",
-                    line=dict(color=color_map.get(reg), dash=dash_map[y]),
-                    legendgroup=label_map.get(reg, reg),     # группируем легендой по региону
-                    legendrank=r_rank * 10 + (0 if y == year_a else 1),  # стабильный порядок
-                    customdata=np.column_stack([
-                        np.full(len(s), label_map.get(reg, reg)),
-                        np.full(len(s), y),
-                        [fmt_hover(v) for v in vals]
-                    ]),
+                    name=f"{label} · {y}",
+                    line=dict(color=color, dash=dash_map[y]),
+                    legendgroup=label,     # группируем легендой по региону
+                    legendrank=rank,
+                    customdata=customdata,
                     hovertemplate=hovertemplate
                 ))
 
                 if show_trend:
-                    mask = ~np.isnan(vals)
-                    if mask.sum() >= 2:
-                        xp = np.arange(len(vals))
-                        k, b = np.polyfit(xp[mask], vals[mask], 1)
-                        fig.add_trace(go.Scatter(
+                    k_all, b_all, n_all = trends_by_year[y]
+                    if n_all[r_rank] >= 2:
+                        k, b = k_all[r_rank], b_all[r_rank]
+                        traces.append(scatter_cls(
                             x=s.index, y=k * xp + b,
                             mode="lines",
-                            line=dict(color=color_map.get(reg), dash="dash"),
-                            name=f"{label_map.get(reg, reg)} · тренд · {y}",
+                            line=dict(color=color, dash="dash"),
+                            name=f"{label} · тренд · {y}",
                             showlegend=False,
                             hoverinfo="skip",                # тренд не попадает в ховер
-                            legendgroup=label_map.get(reg, reg),
-                            legendrank=r_rank * 10 + (0 if y == year_a else 1)
+                            legendgroup=label,
+                            legendrank=rank
                         ))
                 clean_s = s.dropna()
                 if len(clean_s) >= 2:
                     delta_records.append((f"{reg} · {y}", float(clean_s.iloc[-1] - clean_s.iloc[0])))
+        fig.add_traces(traces)
         subtitle = f"Источник: строки «Итого по месяцу». Агрегация за период: {rule_text}."
         fig.update_layout(title={'text': f"{met}<br><sup>{subtitle}</sup>", 'x': 0},
-                          hovermode="x unified", margin=dict(t=70, l=0, r=0, b=0))
+                          hovermode="x unified", margin=dict(t=70, l=0, r=0, b=0),
+                          uirevision=f"{widget_prefix}_{met}")  # зум не сбрасывается между перезапусками
         fig.update_yaxes(tickformat=tickfmt, ticksuffix=suf.strip(), title_text=suf.strip() or None)
         fig.update_yaxes(type="log" if use_log else "linear")
         st.plotly_chart(fig, use_container_width=True)
@@ -5969,24 +6408,13 @@ def _aggregate_period(df_year: pd.DataFrame, regions: list[str], metric: str, mo
     dfm = get_monthly_totals_from_file(df_year, tuple(regions), metric)
     if dfm.empty:
         return {}
-    part = dfm[dfm["Месяц"].astype(str).isin(months)].copy()
+    part = dfm.loc[dfm["Месяц"].isin(months), ["Регион", "Значение"]]
+    part = part.assign(Значение=pd.to_numeric(part["Значение"], errors="coerce")).dropna(subset=["Значение"])
     if part.empty:
         return {}
-    rule = aggregation_rule(metric)
-    out = {}
-    for reg, g in part.groupby("Регион"):
-        vals = pd.to_numeric(g["Значение"], errors="coerce").dropna()
-        if vals.empty:
-            continue
-        if rule == "sum":
-            out[str(reg)] = float(vals.sum())
-        elif rule == "mean":
-            out[str(reg)] = float(vals.mean())
-        elif rule == "last":
-            out[str(reg)] = float(vals.iloc[-1])
-        else:
-            out[str(reg)] = float(vals.mean())
-    return out
+    how = {"sum": "sum", "mean": "mean", "last": "last"}.get(aggregation_rule(metric), "mean")
+    agg = part.groupby("Регион", observed=True)["Значение"].agg(how)
+    return {str(reg): float(v) for reg, v in agg.items()}
 
 
 def treemap_heatmap_block(
@@ -6004,12 +6432,14 @@ def treemap_heatmap_block(
     st.subheader("🗺️ Структура и распределение по месяцам")
     st.caption("Treemap — вклад филиалов; теплокарта — помесячные значения. Используются только метрики из файлов.")
 
-    sub = strip_totals_rows(df_all)
-    sub = sub[(sub["Регион"].isin(regions)) & (sub["Месяц"].astype(str).isin(months_range))]
+    keep = (~totals_row_mask(df_all).to_numpy(dtype=bool)
+            & category_mask(df_all["Регион"], regions)
+            & category_mask(df_all["Месяц"], months_range))
+    sub = df_all.loc[keep]
     if sub.empty:
         st.info("Нет данных."); return
 
-    raw_metric_names = sorted(set(df_all["Показатель"].dropna().unique()))
+    raw_metric_names = raw_metric_names_of(df_all)
     if not raw_metric_names:
         st.warning("Нет метрик для отображения.")
         return
@@ -6033,9 +6463,15 @@ def treemap_heatmap_block(
         st.info("Нет данных за период."); return
     month_for_tree = st.selectbox("Месяц для структуры", options=months_present, index=len(months_present)-1, key=month_key)
 
-    tree_base = sub[(sub["Показатель"] == metric) & (sub["Месяц"].astype(str) == month_for_tree)]
+    # позиции строк по метрике — один проход; дальше срезы по позициям, без масок по всей таблице
+    rows_by_metric = sub.groupby("Показатель", observed=True).indices
+    no_rows = np.array([], dtype=np.intp)
+    tree_base = sub.iloc[rows_by_metric.get(metric, no_rows)]
+    tree_base = tree_base[tree_base["Месяц"] == month_for_tree]
     tree_data = (tree_base.groupby(["Регион","Подразделение"], observed=True)["Значение"]
                        .sum().reset_index().rename(columns={"Значение": "Size"}))
+    # px.treemap берёт max по колонке цвета — с неупорядоченной категорией это ошибка
+    tree_data["Регион"] = tree_data["Регион"].astype(str)
 
     if not tree_data.empty and pd.to_numeric(tree_data["Size"], errors="coerce").fillna(0).abs().sum() > 0:
         fig_t = px.treemap(
@@ -6054,7 +6490,7 @@ def treemap_heatmap_block(
         fig_t.update_layout(margin=dict(t=40,l=0,r=0,b=0), title=f"Структура: {metric} · {month_for_tree}")
         st.plotly_chart(fig_t, use_container_width=True)
         insight_lines = []
-        region_series = tree_data.groupby("Регион")[["Size"]].sum()["Size"]
+        region_series = tree_data.groupby("Регион", observed=True)[["Size"]].sum()["Size"]
         insight = _describe_metric_series(region_series, metric)
         if insight:
             insight_lines.append(insight)
@@ -6089,12 +6525,15 @@ def treemap_heatmap_block(
     )
 
     if by_subdiv:
-        df_loc = sub[sub["Показатель"] == heat_metric].copy()
-        df_loc["RowLabel"] = df_loc["Регион"].astype(str) + " · " + df_loc["Подразделение"].astype(str)
-        df_loc['Месяц'] = pd.Categorical(df_loc['Месяц'].astype(str), categories=ORDER, ordered=True)
-        
-        df_loc['__prio__'] = np.where(df_loc.get("ИсточникФайла", pd.Series(index=df_loc.index, dtype=object)).eq("TOTALS_FILE"), 1, 2)
-        df_loc.sort_values(["RowLabel", "Месяц", "__prio__"], inplace=True)
+        # только нужные колонки; новые — через assign, без полной копии среза
+        df_loc = sub.iloc[rows_by_metric.get(heat_metric, no_rows)]
+        src = df_loc.get("ИсточникФайла", pd.Series(index=df_loc.index, dtype=object))
+        df_loc = df_loc[["Месяц", "Значение"]].assign(
+            # склейка в Arrow-строках, без перехода к объектам Python
+            RowLabel=df_loc["Регион"].astype(TEXT_DTYPE) + " · " + df_loc["Подразделение"].astype(TEXT_DTYPE),
+            Месяц=pd.Categorical(df_loc["Месяц"], categories=ORDER, ordered=True),
+            __prio__=np.where(src.eq("TOTALS_FILE"), 1, 2),
+        ).sort_values(["RowLabel", "Месяц", "__prio__"])
 
         # правило агрегации
         rule = agg_of_metric(heat_metric)
@@ -6109,7 +6548,9 @@ def treemap_heatmap_block(
     else:
         # региональный уровень: уже берём ровно то, что в «Итого по месяцу»
         mat = month_totals_matrix(df_all, tuple(regions), heat_metric)
-        hm = mat.pivot_table(index="Регион", columns="Месяц", values="Значение", aggfunc="first", observed=False)
+        # одна строка на (Регион, Месяц) — достаточно перестановки без агрегации
+        hm = (mat.set_index(["Регион", "Месяц"])["Значение"].unstack("Месяц")
+                 .dropna(how="all").dropna(axis=1, how="all"))
 
     if 'hm' in locals() and not hm.empty:
         hm = hm.reindex(columns=[m for m in months_range if m in hm.columns])
@@ -6160,14 +6601,13 @@ def monthly_totals_table(df_raw: pd.DataFrame, regions: list[str], months_range:
     if df_raw.empty or not months_range:
         return pd.DataFrame()
 
-    filtered = df_raw[
-        df_raw["Регион"].isin(regions) &
-        df_raw["Подразделение"].str.contains(r"^\s*итого\b", case=False, na=False)
-    ].copy()
-    if filtered.empty:
-        filtered = df_raw[df_raw["Регион"].isin(regions)].copy()
+    # нужен только список метрик — берём одну колонку, без копии строк
+    in_regions = df_raw["Регион"].isin(regions)
+    metric_col = df_raw.loc[in_regions & totals_row_mask(df_raw), "Показатель"]
+    if metric_col.empty:
+        metric_col = df_raw.loc[in_regions, "Показатель"]
 
-    all_metrics = sorted(filtered["Показатель"].dropna().unique().tolist())
+    all_metrics = sorted(metric_col.dropna().unique().tolist())
     rows = []
 
     for metric in all_metrics:
@@ -6176,7 +6616,7 @@ def monthly_totals_table(df_raw: pd.DataFrame, regions: list[str], months_range:
             fallback = df_raw[
                 df_raw["Регион"].isin(regions) &
                 (df_raw["Показатель"] == metric) &
-                (df_raw["Месяц"].astype(str) != "Итого")
+                (df_raw["Месяц"] != "Итого")
             ]
             dfm = fallback.groupby("Месяц", observed=True)["Значение"].sum().reset_index()
         else:
@@ -6185,7 +6625,7 @@ def monthly_totals_table(df_raw: pd.DataFrame, regions: list[str], months_range:
         rule = aggregation_rule(metric)
 
         for m in months_range:
-            mask = dfm["Месяц"].astype(str) == m
+            mask = dfm["Месяц"] == m
             vals = pd.to_numeric(dfm.loc[mask, "Значение"], errors="coerce")
             if vals.empty:
                 row[m] = np.nan
@@ -6224,28 +6664,31 @@ def monthly_totals_table(df_raw: pd.DataFrame, regions: list[str], months_range:
     return dfw.sort_values(by="Показатель", key=row_order).reset_index(drop=True)
 
 def provided_totals_from_files(df_all: pd.DataFrame, regions: list[str], months_range: list[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    df_tot = df_all[
-        (df_all["Регион"].isin(regions)) &
-        df_all["Подразделение"].str.contains(r"^\s*итого\b", case=False, na=False) &
-        (df_all["Месяц"].astype(str).isin(months_range + ["Итого"]))
-    ].copy()
-    if df_tot.empty:
+    # флаг «Итого» уже посчитан при загрузке; Месяц/Регион — категории, isin идёт по кодам
+    mask = (totals_row_mask(df_all).to_numpy(dtype=bool)
+            & df_all["Регион"].isin(regions).to_numpy()
+            & df_all["Месяц"].isin(months_range + ["Итого"]).to_numpy())
+    if not mask.any():
         return pd.DataFrame(), pd.DataFrame()
+    cols = [c for c in ("Показатель", "Месяц", "Значение", "ИсточникФайла") if c in df_all.columns]
+    df_tot = df_all.iloc[np.flatnonzero(mask), df_all.columns.get_indexer(cols)]
 
     priority_map = {"RECALC_TOTAL": 0, "TOTALS_FILE": 1}
-    src = df_tot.get("ИсточникФайла", pd.Series(index=df_tot.index, dtype=object))
-    df_tot["__prio__"] = src.map(priority_map).fillna(2).astype(int)
-    df_tot.sort_values(["Показатель","Месяц","__prio__"], inplace=True)
+    src = df_tot.get("ИсточникФайла", pd.Series(index=df_tot.index, dtype=object)).astype(object)
+    df_tot = (df_tot.assign(__prio__=src.map(priority_map).fillna(2).astype(int))
+                    .sort_values(["Показатель","Месяц","__prio__"]))
     best = df_tot.groupby(["Показатель","Месяц"], observed=True).first().reset_index()
 
-    totals_row = best.pivot_table(index="Показатель", columns="Месяц", values="Значение", aggfunc="first", observed=False).reset_index()
+    totals_row = (best.set_index(["Показатель", "Месяц"])["Значение"].unstack("Месяц")
+                      .dropna(how="all").dropna(axis=1, how="all").reset_index())
     cols_ordered = ["Показатель"] + [m for m in months_range if m in totals_row.columns] + (["Итого"] if "Итого" in totals_row.columns else [])
     totals_row = totals_row.reindex(columns=cols_ordered)
 
     totals_col = pd.DataFrame()
-    if "Итого" in best["Месяц"].astype(str).unique():
-        it_col = best[best["Месяц"].astype(str) == "Итого"][["Показатель", "Значение"]].rename(columns={"Значение": "Итого"})
-        totals_col = it_col.groupby("Показатель")["Итого"].first().reset_index()
+    is_total = (best["Месяц"] == "Итого").to_numpy()
+    if is_total.any():
+        it_col = best.loc[is_total, ["Показатель", "Значение"]].rename(columns={"Значение": "Итого"})
+        totals_col = it_col.groupby("Показатель", observed=True)["Итого"].first().reset_index()
 
     return totals_row, totals_col
 
@@ -6260,9 +6703,33 @@ def month_check_block(df_all: pd.DataFrame, regions: list[str], months_range: li
     colcfg["Показатель"] = st.column_config.TextColumn("Показатель")
     st.dataframe(table, use_container_width=True, column_config=colcfg)
 
-def export_block(df_long: pd.DataFrame):
+@st.cache_data(show_spinner=False, max_entries=2)
+def _export_csv_bytes(source_ids: Tuple[str, ...], _sources: Tuple[pd.DataFrame, ...],
+                      regions: Tuple[str, ...], months: Tuple[str, ...]) -> bytes:
+    """
+    CSV (UTF-8 с BOM) по выборке: кэш ключуется годами (их df_id), регионами и месяцами,
+    срез строится только при промахе. to_csv пишет кусками сразу в байтовый буфер — без промежуточной строки на весь файл.
+    """
+    # сначала фильтр по каждому году, склеиваем уже отобранные строки — без копии обоих лет целиком
+    parts = [src[category_mask(src["Регион"], regions) & category_mask(src["Месяц"], months)] for src in _sources]
+    df_long = parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+    df_long = df_long.drop(columns=[TOTALS_FLAG_COL], errors="ignore")
+    buf = BytesIO()
+    buf.write("\ufeff".encode("utf-8"))
+    df_long.to_csv(buf, index=False, encoding="utf-8", chunksize=50_000)
+    return buf.getvalue()
+
+@st.fragment
+def export_block(sources: List[pd.DataFrame], regions: List[str], months_range: List[str]):
     st.subheader("📥 Экспорт данных"); st.caption("Длинный формат: Регион · Год · Подразделение · Показатель · Месяц · Значение.")
-    csv_bytes = df_long.to_csv(index=False).encode("utf-8-sig")
+    # вкладки исполняются все сразу — CSV готовим только по запросу;
+    # переключатель перезапускает лишь этот фрагмент, а не всю страницу
+    if not st.toggle("Подготовить CSV", key="export_prepare"):
+        return
+    # ключ — выборка, а не отфильтрованная таблица: срезы по годам зарегистрированы ключом «набор файлов:год»,
+    # так что frame_id здесь не хэширует данные, а повторный запуск фрагмента не строит срез заново
+    csv_bytes = _export_csv_bytes(tuple(frame_id(src) for src in sources), tuple(sources),
+                                  tuple(regions), tuple(months_range))
     st.download_button("⬇️ Скачать объединённый датасет (CSV)", data=csv_bytes, file_name="NUZ_combined_Long.csv", mime="text/csv")
 
 def info_block():
@@ -6283,6 +6750,43 @@ def info_block():
 - **Сравнивайте средний размер займа и процент выкупа изделий**. Слишком большие средние суммы могут означать, что филиал выдает займы под дорогие товары, которые клиентам сложнее выкупить, что повышает риск перехода в распродажу.
 """)
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def assemble_df_all(files_key: Tuple[Tuple[Any, ...], ...], _dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Сборка общего датасета из разобранных файлов: concat, нормализация «Регион», типы, проценты.
+    Результат зависит только от файлов, поэтому кэш — по files_key (имя, отпечаток, регион, год);
+    сами таблицы (_dfs) не хэшируются.
+    """
+    df_all = concat_frames(_dfs)
+    df_all = append_risk_share_metric(df_all)
+
+    # доп. нормализация поля "Регион": регионов единицы — чистим уникальные имена, строки только переназначаем
+    regions = df_all["Регион"]
+    names = {r: clean_region_name(str(r)) for r in regions.dropna().unique()}
+    df_all["Регион"] = regions.map(names).astype("category")
+
+    df_all["Значение"] = pd.to_numeric(df_all["Значение"], errors="coerce")
+    df_all["Год"] = pd.to_numeric(df_all["Год"], errors="coerce").astype("Int16")  # годы 20xx — хватает int16
+    for c in ["Подразделение", "Показатель", "Код", "Месяц", "ИсточникФайла", "Категория"]:
+        if c == "Месяц":
+            df_all[c] = df_all[c].astype(pd.CategoricalDtype(categories=ORDER_WITH_TOTAL, ordered=True))
+        elif c in ("Показатель", "Категория", "Код", "ИсточникФайла"):
+            df_all[c] = df_all[c].astype("category")
+        else:
+            df_all[c] = df_all[c].astype(TEXT_DTYPE)
+
+    # проверяем только уникальные названия, маска — одним isin
+    pct_metrics = {m for m in df_all["Показатель"].dropna().unique() if is_percent_metric(m)}
+    mask_pct = df_all["Показатель"].isin(pct_metrics).to_numpy()
+    df_all.loc[mask_pct, "Значение"] = normalize_percent_series(df_all.loc[mask_pct, "Значение"])
+    return df_all
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def months_by_year(files_key: Tuple[Tuple[Any, ...], ...], _df_all: pd.DataFrame) -> Dict[int, List[str]]:
+    """Месяцы с данными по каждому году (в порядке ORDER) — один проход на набор файлов, кэш по files_key."""
+    pairs = _df_all[["Год", "Месяц"]].dropna().drop_duplicates()
+    return {int(y): sorted_months_safe(g["Месяц"]) for y, g in pairs.groupby("Год")}
+
 def main():
     st.markdown(f"# 📊 Аналитический дашборд: НЮЗ  \n<span class='badge'>Версия {APP_VERSION}</span>", unsafe_allow_html=True)
     sidebar = st.sidebar.container()
@@ -6305,57 +6809,70 @@ def main():
     # strict_mode теперь не нужен как опция, он определяется глобальным флагом SIMPLE_MODE
     strict_mode = SIMPLE_MODE
 
-    dfs, errors = [], []
-    with st.spinner("Чтение и обработка файлов..."):
-        for up in uploads:
-            try:
-                stem = Path(up.name).stem
-                region_name = f"{region_prefix.strip()}: {stem}" if region_prefix.strip() else stem
-                year_guess = guess_year_from_filename(up.name)
-
-                key_year = f"year_for_{up.name}"
-                if year_guess is None:
-                    st.sidebar.warning(f"Не удалось определить год из имени: {up.name}")
-                    st.sidebar.caption("Выберите год вручную.")
-                    year_guess = st.sidebar.selectbox(
-                        f"Год для файла: {up.name}",
-                        options=[2023, 2024, 2025, 2026],
-                        index=1,
-                        key=key_year
-                    )
-                dfs.append(parse_excel(up.getvalue(), region_name, file_year=year_guess))
-            except Exception as e:
-                errors.append(f"**{up.name}**: {e}")
+    dfs, errors, parsed_keys = [], [], []
+    # виджеты (ручной выбор года) — только в основном потоке, разбор файлов — параллельно
+    jobs = []
+    for up in uploads:
+        try:
+            stem = Path(up.name).stem
+            region_name = f"{region_prefix.strip()}: {stem}" if region_prefix.strip() else stem
+            year_guess = guess_year_from_filename(up.name)
+
+            key_year = f"year_for_{up.name}"
+            if year_guess is None:
+                st.sidebar.warning(f"Не удалось определить год из имени: {up.name}")
+                st.sidebar.caption("Выберите год вручную.")
+                year_guess = st.sidebar.selectbox(
+                    f"Год для файла: {up.name}",
+                    options=[2023, 2024, 2025, 2026],
+                    index=1,
+                    key=key_year
+                )
+            jobs.append((up.name, up.getvalue(), region_name, year_guess))
+        except Exception as e:
+            errors.append(f"**{up.name}**: {e}")
+
+    script_ctx = get_script_run_ctx()
+
+    def _parse_job(job):
+        add_script_run_ctx(threading.current_thread(), script_ctx)
+        _, file_bytes, region_name, year_guess = job
+        return parse_excel(file_bytes, region_name, file_year=year_guess)
+
+    # разобранные файлы живут в сессии: на перезапуске разбираем только новые загрузки
+    parsed_cache = st.session_state.setdefault(PARSED_CACHE_KEY, {})
+    job_keys = [(name, content_digest(data), region_name, year) for name, data, region_name, year in jobs]
+    todo = [(job, key) for job, key in zip(jobs, job_keys) if key not in parsed_cache]
+    if todo:
+        with st.spinner("Чтение и обработка файлов..."):
+            with ThreadPoolExecutor(max_workers=min(PARSE_WORKERS, len(todo))) as pool:
+                futures = [pool.submit(_parse_job, job) for job, _ in todo]
+                for (job, key), fut in zip(todo, futures):
+                    try:
+                        parsed_cache[key] = fut.result()
+                    except Exception as e:
+                        errors.append(f"**{job[0]}**: {e}")
+    for key in set(parsed_cache) - set(job_keys):
+        del parsed_cache[key]  # файл убрали из загрузок
+    for key in job_keys:
+        if key in parsed_cache:
+            dfs.append(parsed_cache[key])
+            parsed_keys.append(key)
 
     if errors: st.error("Ошибки при чтении файлов:\n\n" + "\n\n".join(errors))
     if not dfs: st.stop()
-    df_all = pd.concat(dfs, ignore_index=True)
-    df_all = append_risk_share_metric(df_all)
-
-    # доп. нормализация поля "Регион"
-    df_all["Регион"] = (df_all["Регион"]
-        .str.replace(r"\s{2,}", " ", regex=True)
-        .str.replace(r"[·.]+$", "", regex=True)
-        .str.strip()
-        .astype("string")
-    )
-
-    df_all["Значение"] = pd.to_numeric(df_all["Значение"], errors="coerce")
-    df_all["Год"] = pd.to_numeric(df_all["Год"], errors="coerce").astype("Int64")
-    for c in ["Подразделение", "Показатель", "Код", "Месяц", "ИсточникФайла", "Категория"]:
-        if c == "Месяц":
-            df_all[c] = df_all[c].astype(pd.CategoricalDtype(categories=ORDER_WITH_TOTAL, ordered=True))
-        else:
-            df_all[c] = df_all[c].astype("string")
+    files_key = tuple(parsed_keys)
+    df_all = assemble_df_all(files_key, dfs)
+    # ключи таблиц выводим из набора файлов — кэши по df_id не хэшируют df_all и срезы по годам
+    data_key = content_digest(repr(files_key).encode("utf-8"))
+    register_frame(df_all, data_key)
+    year_months = months_by_year(files_key, df_all)
 
     years_all = sorted([int(y) for y in pd.Series(df_all["Год"].dropna().unique()).astype(int)])
     if not years_all:
         st.error("Не удалось определить год ни для одного из файлов. Проверьте названия файлов или выберите год вручную.")
         st.stop()
 
-    mask_pct = df_all["Показатель"].apply(is_percent_metric)
-    df_all.loc[mask_pct, "Значение"] = normalize_percent_series(df_all.loc[mask_pct, "Значение"])
-
     scenario_options = list(SCENARIO_CONFIGS.keys())
     with sidebar:
         st.markdown("<hr class='sidebar-divider'>", unsafe_allow_html=True)
@@ -6387,8 +6904,8 @@ def main():
                 label_visibility="collapsed",
                 key="single_year_select"
             )
-        df_current = df_all[df_all["Год"] == year_current].copy()
-        months_in_data = sorted_months_safe(df_current["Месяц"])
+        df_current = year_frame(df_all, data_key, year_current)
+        months_in_data = year_months.get(year_current, [])
         if not months_in_data:
             st.error("В выбранном году нет данных с распознанными месяцами."); st.stop()
         df_previous = None
@@ -6399,10 +6916,10 @@ def main():
             col_a, col_b = st.columns(2)
             year_previous = col_a.selectbox("Год A", options=years_all, index=max(0, len(years_all) - 2), key="year_a", label_visibility="collapsed")
             year_current = col_b.selectbox("Год B", options=years_all, index=len(years_all) - 1, key="year_b", label_visibility="collapsed")
-        df_previous = df_all[df_all["Год"] == year_previous].copy()
-        df_current = df_all[df_all["Год"] == year_current].copy()
-        months_a = sorted_months_safe(df_previous["Месяц"])
-        months_b = sorted_months_safe(df_current["Месяц"])
+        df_previous = year_frame(df_all, data_key, year_previous)
+        df_current = year_frame(df_all, data_key, year_current)
+        months_a = set(year_months.get(year_previous, []))
+        months_b = set(year_months.get(year_current, []))
         months_in_data = [m for m in ORDER if m in months_a and m in months_b]
         if not months_in_data:
             st.error("В пересечении выбранных годов нет данных по месяцу."); st.stop()
@@ -6446,7 +6963,7 @@ def main():
             label_visibility="collapsed"
         )
         st.caption(f"Период: {start_m} – {end_m}")
-    months_range = ORDER[ORDER.index(start_m): ORDER.index(end_m) + 1]
+    months_range = ORDER[_ORDER_POS[start_m]: _ORDER_POS[end_m] + 1]
 
     with sidebar:
         st.markdown("<hr class='sidebar-divider'>", unsafe_allow_html=True)
@@ -6586,7 +7103,7 @@ def main():
         stats_cols = st.columns(4)
         stats_cols[0].metric("Файлов", len(uploads))
         stats_cols[1].metric("Регионов", len(regions_all))
-        stats_cols[2].metric("Подразделений", strip_totals_rows(df_current)["Подразделение"].nunique())
+        stats_cols[2].metric("Подразделений", len(branch_names(df_current)))
         stats_cols[3].metric("Период данных", f"{months_in_data[0]} – {months_in_data[-1]}")
         st.divider()
 
@@ -6611,8 +7128,8 @@ def main():
             with tab:
                 renderer(ctx)
     else:
-        combined = pd.concat([df_previous, df_current], ignore_index=True)
-        regions_all = sorted(map(str, combined["Регион"].unique()))
+        # регионы двух лет — объединением уникальных, без склейки таблиц
+        regions_all = sorted(set(map(str, df_previous["Регион"].unique())) | set(map(str, df_current["Регион"].unique())))
         with sidebar:
             st.markdown("<p class='sidebar-title'>Регионы</p>", unsafe_allow_html=True)
             pending_key = "compare_regions_pending"
@@ -6683,7 +7200,7 @@ def main():
         stats_cols = st.columns(4)
         stats_cols[0].metric("Файлов", len(uploads))
         stats_cols[1].metric("Регионов", len(regions_all))
-        stats_cols[2].metric("Подразделений", strip_totals_rows(combined)["Подразделение"].nunique())
+        stats_cols[2].metric("Подразделений", len(branch_names(df_previous) | branch_names(df_current)))
         stats_cols[3].metric("Период данных", f"{months_in_data[0]} – {months_in_data[-1]}")
         st.divider()
 
@@ -7034,14 +7551,10 @@ def render_data_page(ctx: PageContext) -> None:
     render_correlation_block(ctx.df_current, ctx.regions, ctx.months_range, default_metrics=FORECAST_METRICS)
     st.divider()
     if ctx.mode == "compare" and ctx.df_previous is not None:
-        export_source = pd.concat([ctx.df_previous, ctx.df_current], ignore_index=True)
+        export_sources = [ctx.df_previous, ctx.df_current]
     else:
-        export_source = ctx.df_current
-    export_filtered = export_source[
-        (export_source["Регион"].isin(ctx.regions))
-        & (export_source["Месяц"].astype(str).isin(ctx.months_range))
-    ]
-    export_block(export_filtered)
+        export_sources = [ctx.df_current]
+    export_block(export_sources, ctx.regions, ctx.months_range)
     info_block()
     render_faq_block()
 
@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("streamlit")
+import nuz_dashboard_app_v4 as app
+
+
+def _long(rows) -> pd.DataFrame:
+    """Долгая таблица в типах после загрузки из (Регион, Подразделение, Показатель, Месяц, Значение, ИсточникФайла)."""
+    df = pd.DataFrame(rows, columns=["Регион", "Подразделение", "Показатель", "Месяц", "Значение", "ИсточникФайла"])
+    for col in ("Регион", "Показатель", "ИсточникФайла"):
+        df[col] = df[col].astype("category")
+    df["Подразделение"] = df["Подразделение"].astype(app.TEXT_DTYPE)
+    df["Месяц"] = pd.Categorical(df["Месяц"], categories=app.ORDER_WITH_TOTAL, ordered=True)
+    df[app.TOTALS_FLAG_COL] = app.totals_flag(df["Подразделение"])
+    return df
+
+
+def test_risk_share_is_zero_when_below_loan_row_is_missing():
+    rows = [
+        ("Москва", "Ломбард №1", app.Metrics.REVENUE.value, "Январь", 100.0),
+        ("Москва", "Ломбард №1", app.Metrics.BELOW_LOAN.value, "Январь", 5.0),
+        ("Москва", "Ломбард №1", app.Metrics.REVENUE.value, "Февраль", 50.0),
+    ]
+    df = pd.DataFrame(rows, columns=["Регион", "Подразделение", "Показатель", "Месяц", "Значение"])
+    df = df.assign(Категория="НЮЗ", Код="1", Год=2024, ИсточникФайла="BRANCHES_FILE")
+    for col in ("Регион", "Показатель", "Категория", "Код", "ИсточникФайла"):
+        df[col] = df[col].astype("category")
+    df["Месяц"] = pd.Categorical(df["Месяц"], categories=app.ORDER_WITH_TOTAL, ordered=True)
+
+    out = app.append_risk_share_metric(df)
+    share = out[out["Показатель"] == app.Metrics.RISK_SHARE.value]
+
+    assert dict(zip(share["Месяц"].astype(str), share["Значение"])) == {"Январь": 5.0, "Февраль": 0.0}
+
+
+def test_region_month_matrix_zero_fills_summed_months():
+    gp = pd.DataFrame({"Регион": ["Москва", "Москва", "Омск"], "Месяц": ["Январь", "Февраль", "Январь"], "Значение": [1.0, 2.0, 3.0]})
+    months = ["Январь", "Февраль"]
+
+    # из строк «Итого» (месяцы — строки): пропуск остаётся пропуском
+    assert app._region_month_matrix(gp, months, ["Москва", "Омск"])["Омск"].isna().tolist() == [False, True]
+
+    gp["Регион"] = gp["Регион"].astype("category")
+    gp["Месяц"] = pd.Categorical(gp["Месяц"], categories=app.ORDER_WITH_TOTAL, ordered=True)
+    wide = app._region_month_matrix(gp, months, ["Москва", "Омск"])
+    assert wide["Омск"].tolist() == [3.0, 0.0]
+    assert wide["Москва"].tolist() == [1.0, 2.0]
+
+
+def test_monthly_totals_prefer_recalculated_then_file_totals():
+    rev = app.Metrics.REVENUE.value
+    df = _long([
+        ("Москва", "Итого Москва", rev, "Январь", 20.0, "TOTALS_FILE"),
+        ("Москва", "Итого Москва", rev, "Январь", 10.0, "RECALC_TOTAL"),
+        ("Москва", "Итого Москва", rev, "Февраль", 5.0, "BRANCHES_FILE"),
+        ("Москва", "Итого Москва", rev, "Февраль", 30.0, "TOTALS_FILE"),
+        ("Москва", "Итого Москва", rev, "Март", 3.0, "BRANCHES_FILE"),
+        ("Москва", "Итого Москва", rev, "Март", 4.0, "BRANCHES_FILE"),
+        ("Москва", "Ломбард №1", rev, "Март", 100.0, "BRANCHES_FILE"),
+    ])
+
+    out = app.get_monthly_totals_from_file(df, ("Москва",), rev)
+
+    assert dict(zip(out["Месяц"].astype(str), out["Значение"])) == {"Январь": 10.0, "Февраль": 30.0, "Март": 7.0}
+
+
+def test_aggregated_data_takes_last_month_for_snapshot_metrics():
+    debt, rev = app.Metrics.DEBT_NO_SALE.value, app.Metrics.REVENUE.value
+    rows = [
+        ("Москва", "Ломбард №1", debt, "Март", 7.0, "BRANCHES_FILE"),
+        ("Москва", "Ломбард №1", debt, "Январь", 5.0, "BRANCHES_FILE"),
+        ("Москва", "Ломбард №1", debt, "Февраль", 9.0, "BRANCHES_FILE"),
+        ("Москва", "Ломбард №1", rev, "Январь", 1.0, "BRANCHES_FILE"),
+        ("Москва", "Ломбард №1", rev, "Март", 2.0, "BRANCHES_FILE"),
+        ("Москва", "Итого Москва", debt, "Март", 999.0, "TOTALS_FILE"),
+    ]
+
+    out = app.get_aggregated_data(_long(rows), ("Москва",), tuple(app.ORDER[:3]))
+
+    assert out["Подразделение"].tolist() == ["Ломбард №1"]
+    assert out[debt].tolist() == [7.0]
+    assert out[rev].tolist() == [3.0]
+
+    # «Март» вне периода — снимок берётся на последний выбранный месяц
+    out = app.get_aggregated_data(_long(rows), ("Москва",), tuple(app.ORDER[:2]))
+    assert out[debt].tolist() == [9.0]
@@ -0,0 +1,96 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+pytest.importorskip("streamlit")
+import nuz_dashboard_app_v4 as app
+
+REVENUE = app.Metrics.REVENUE.value
+LOAN_ISSUE = app.Metrics.LOAN_ISSUE.value
+
+
+def _book(rows) -> bytes:
+    """Книга с одним листом TDSheet из списка строк."""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "TDSheet"
+    for row in rows:
+        ws.append(row)
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def test_one_left_column_row_without_label_is_skipped():
+    data = _book([
+        ["Показатель", "Январь 2024", "Февраль 2024", "Март 2024"],
+        [REVENUE, 10, 20, 30],
+        [None, 1, 2, 3],
+        [LOAN_ISSUE, 5, 6, 7],
+    ])
+    out = app.parse_excel(data, "Омск.xlsx", 2024)
+    months = out[out["Месяц"] != "Итого"]
+
+    assert months.groupby("Показатель", observed=True)["Значение"].sum().to_dict() == {
+        LOAN_ISSUE: 18.0, REVENUE: 60.0,
+    }
+    assert len(months) == 6
+
+
+@pytest.mark.parametrize("n_left", [1, 2, 3])
+def test_metric_label_is_rightmost_text_left_of_months(n_left):
+    def row(branch, metric):
+        cells = [None] * n_left
+        if n_left > 1:
+            cells[0] = branch
+        cells[-1] = metric
+        return cells
+
+    left = np.array([
+        row("Ломбард №7", REVENUE),
+        row(None, None),
+        row(None, LOAN_ISSUE),
+        row(None, "неизвестная строка"),
+    ], dtype=object)
+    values = np.array([[1.0, 2.0], [3.0, 4.0], [5.0, np.nan], [6.0, 7.0]])
+
+    out = app._extract_metric_rows(left, values, ["Январь", "Февраль"])
+    months = out[~out["__total__"]]
+
+    assert months["Показатель"].tolist() == [REVENUE, REVENUE, LOAN_ISSUE]
+    assert months["Значение"].tolist() == [1.0, 2.0, 5.0]
+    if n_left > 1:
+        assert set(out["Подразделение"]) == {"Ломбард №7"}
+        assert set(out["Код"]) == {"7"}
+
+
+def test_coerce_number_block_parses_text_numbers():
+    block = np.array([
+        [100, "1 200,5", "12,5%", "1.234.567,8"],
+        ["1,234,567", " 3 000", None, "нет"],
+        [True, 2.5, "", "7"],
+    ], dtype=object)
+
+    out = app.coerce_number_block(block)
+
+    np.testing.assert_array_equal(out, [
+        [100.0, 1200.5, 12.5, 1234567.8],
+        [1234567.0, 3000.0, np.nan, np.nan],
+        [np.nan, 2.5, np.nan, 7.0],
+    ])
+
+
+def test_month_tokens_frame_matches_normalize_month_token():
+    cells = ["Показатель", "Январь 2024", "фев.", "Март 2024 г", " АПР ", "Итого", 5, None]
+    head = pd.DataFrame([cells, cells[::-1]])
+
+    tokens = app._month_tokens_frame(head)
+
+    assert tokens.shape == head.shape
+    assert tokens.iloc[0, 1:5].tolist() == ["Январь", "Февраль", "Март", "Апрель"]
+    for r in range(len(head)):
+        expected = [app.normalize_month_token(c) for c in head.iloc[r]]
+        assert [t if isinstance(t, str) else None for t in tokens.iloc[r]] == expected
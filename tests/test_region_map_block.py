@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("streamlit")
+import nuz_dashboard_app_v4 as app
+
+
+def _frame() -> pd.DataFrame:
+    """Долгая таблица в типах после загрузки: Регион/Показатель — категории, Подразделение — string."""
+    rows = [
+        (reg, branch, app.Metrics.REVENUE.value, month, float(val))
+        for reg, branches in {"Москва": ["Ломбард №1", "Ломбард №2"], "Омск": ["Ломбард №3"]}.items()
+        for branch in branches
+        for month, val in zip(app.ORDER[:3], (10, 20, 30))
+    ]
+    df = pd.DataFrame(rows, columns=["Регион", "Подразделение", "Показатель", "Месяц", "Значение"])
+    df["Регион"] = df["Регион"].astype("category")
+    df["Показатель"] = df["Показатель"].astype("category")
+    df["Подразделение"] = df["Подразделение"].astype(app.TEXT_DTYPE)
+    df["Месяц"] = pd.Categorical(df["Месяц"], categories=app.ORDER_WITH_TOTAL, ordered=True)
+    df[app.TOTALS_FLAG_COL] = np.zeros(len(df), dtype=bool)
+    return df
+
+
+def test_leaderboard_renders_with_categorical_regions(monkeypatch):
+    charts, tables = [], []
+    monkeypatch.setattr(app.st, "radio", lambda label, options, **kw: "Лента лидеров")
+    monkeypatch.setattr(app.st, "selectbox", lambda label, options, **kw: options[0])
+    monkeypatch.setattr(app.st, "plotly_chart", lambda fig, **kw: charts.append(fig))
+    monkeypatch.setattr(app.st, "dataframe", lambda data, **kw: tables.append(data))
+    for name in ("subheader", "caption", "info"):
+        monkeypatch.setattr(app.st, name, lambda *a, **kw: None)
+
+    df = _frame()
+    ctx = app.PageContext(
+        mode="single", df_current=df, df_previous=None, agg_current=pd.DataFrame(),
+        regions=["Москва", "Омск"], months_range=app.ORDER[:3], months_available=app.ORDER[:3],
+        scenario_name="", year_current=2024, year_previous=None, color_map={}, strict_mode=True,
+    )
+    app.render_region_map_block(ctx)
+
+    assert len(charts) == 1
+    assert set(charts[0].data[0].y) == {"Москва · Ломбард №1", "Москва · Ломбард №2", "Омск · Ломбард №3"}
+    assert len(tables[0]) == 3